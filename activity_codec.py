@@ -0,0 +1,111 @@
+import json
+import sys
+import zlib
+from array import array
+from boto3.dynamodb.types import Binary
+
+# Large individual entry attributes, keyed by the name Strava uses for them
+BLOB_ATTRIBUTES = {
+    'best_efforts': 'bestEfforts',
+    'segment_efforts': 'segmentEfforts',
+    'laps': 'laps'
+}
+
+# First byte of every encoded blob, bump it when the layout changes
+ZLIB_JSON_V1 = 1
+
+
+def encode_blob(value):
+    payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return bytes([ZLIB_JSON_V1]) + zlib.compress(payload)
+
+
+def decode_blob(stored):
+    if stored is None:
+        return None
+    # Items written before blobs were compressed hold plain JSON strings
+    if isinstance(stored, str):
+        return json.loads(stored)
+    if isinstance(stored, Binary):
+        stored = stored.value
+    version, payload = stored[0], stored[1:]
+    if version == ZLIB_JSON_V1:
+        return json.loads(zlib.decompress(payload))
+    raise ValueError(f"Unknown activity blob version {version}")
+
+
+def decode_item_blobs(item):
+    # For endpoints that hand stored items straight to the JSON encoder
+    blob_keys = [key for key in BLOB_ATTRIBUTES.values() if key in item]
+    if not any(isinstance(item[key], (bytes, Binary)) for key in blob_keys):
+        return item
+    return {**item, **{key: json.dumps(decode_blob(item[key])) for key in blob_keys}}
+
+
+# Stream schemes, picked per Strava stream key
+SCALED_DELTA = 'd'
+INT_DELTA = 'i'
+FLOAT32 = 'f'
+STREAM_V1 = 1
+LATLNG_SCALE = 1e6
+INT_STREAMS = ['time', 'heartrate', 'cadence', 'watts', 'temp', 'moving']
+
+
+def stream_scheme(key):
+    if key == 'latlng':
+        return SCALED_DELTA
+    if key in INT_STREAMS:
+        return INT_DELTA
+    return FLOAT32
+
+
+def deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+def running_sum(values):
+    total = 0
+    for value in values:
+        total += value
+        yield total
+
+
+def encode_stream(key, data):
+    # latlng pairs become micro-degree integers and every integer stream is
+    # delta encoded, both of which zlib squeezes far better than raw floats
+    scheme = stream_scheme(key)
+    if scheme == SCALED_DELTA:
+        flat = [round(value * LATLNG_SCALE) for pair in data for value in pair]
+        packed = array('i', [*deltas(flat[0::2]), *deltas(flat[1::2])])
+    elif scheme == INT_DELTA:
+        packed = array('i', deltas(int(value) for value in data))
+    else:
+        packed = array('f', data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return bytes([STREAM_V1]) + scheme.encode('ascii') + zlib.compress(packed.tobytes())
+
+
+def decode_stream(key, stored):
+    if isinstance(stored, Binary):
+        stored = stored.value
+    version, scheme, payload = stored[0], chr(stored[1]), stored[2:]
+    if version != STREAM_V1:
+        raise ValueError(f"Unknown activity stream version {version}")
+    packed = array('f' if scheme == FLOAT32 else 'i')
+    packed.frombytes(zlib.decompress(payload))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    if scheme == SCALED_DELTA:
+        half = len(packed) // 2
+        lats = running_sum(packed[:half])
+        lngs = running_sum(packed[half:])
+        return [[lat / LATLNG_SCALE, lng / LATLNG_SCALE] for lat, lng in zip(lats, lngs)]
+    if scheme == INT_DELTA:
+        values = list(running_sum(packed))
+        return [bool(value) for value in values] if key == 'moving' else values
+    # float32 keeps ~7 significant digits, round off the noise it adds
+    return [round(value, 2) for value in packed]
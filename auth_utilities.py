@@ -1,16 +1,24 @@
 import os
-import time
+import threading
 from flask import request, redirect, make_response
-import requests
 import json
 import boto3
 from pprint import pprint
 from botocore.exceptions import ClientError
 from flask import Blueprint
+from strava_client import get_strava_client, STRAVA_API_URL
+from token_cache import get_token_cache, SingleFlight
+from dynamo_utilities import get_table
+from concurrent.futures import ThreadPoolExecutor
 
 
 auth_controller_bp = Blueprint('auth_controller', __name__)
 
+refresh_flight = SingleFlight()
+refresh_executor = ThreadPoolExecutor(max_workers=2)
+scheduled_refreshes = set()
+scheduled_refreshes_lock = threading.Lock()
+
 
 @auth_controller_bp.route('/srg/auth', methods=["GET"])
 def route_auth():
@@ -39,12 +47,12 @@ def exchange_token():
     try:
         client_id = os.environ.get("strava_client_id")
         client_secret = os.environ.get("strava_client_secret")
-        response = requests.post(url='https://www.strava.com/oauth/token', data={
+        response = get_strava_client().post('https://www.strava.com/oauth/token', data={
             'client_id': client_id,
             'client_secret': client_secret,
             'code': code,
             'grant_type': 'authorization_code'
-        })
+        }, rate_limited=False)
         strava_tokens = response.json()
         athlete_id = str(strava_tokens['athlete']['id'])
         tokens = {
@@ -62,8 +70,7 @@ def exchange_token():
 
 def upsert_tokens(tokens):
     try:
-        dynamodb = boto3.resource('dynamodb')
-        tokens_table = dynamodb.Table('srg-token-table')
+        tokens_table = get_table('srg-token-table')
         key = {'athleteId': tokens['athlete_id']}
 
         update_expression = 'SET #accessTokenAttr = :accessTokenValue, #refreshTokenAttr = :refreshTokenValue, #expiresAtAttr = :expiresAtValue'
@@ -83,6 +90,7 @@ def upsert_tokens(tokens):
             UpdateExpression=update_expression,
             ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
         )
+        get_token_cache().invalidate(tokens['athlete_id'])
         return response
     except Exception as e:
         pprint(e)
@@ -92,12 +100,12 @@ def upsert_tokens(tokens):
 def refresh_tokens(athlete_id, refresh_token):
     client_id = os.environ.get('strava_client_id')
     client_secret = os.environ.get('strava_client_secret')
-    strava_tokens = requests.post(url="https://www.strava.com/api/v3/oauth/token", data={
+    strava_tokens = get_strava_client().post(f"{STRAVA_API_URL}/oauth/token", data={
         'client_id': client_id,
         'client_secret': client_secret,
         'grant_type': 'refresh_token',
         'refresh_token': refresh_token
-    })
+    }, rate_limited=False)
     strava_tokens = strava_tokens.json()
     tokens = {
         'athlete_id': athlete_id,
@@ -105,13 +113,55 @@ def refresh_tokens(athlete_id, refresh_token):
         'refresh_token': strava_tokens['refresh_token'],
         'expires_at': strava_tokens['expires_at']
     }
-    upsert_tokens(tokens)
+    result = upsert_tokens(tokens)
+    if not isinstance(result, Exception):
+        get_token_cache().put(athlete_id, {
+            'accessToken': tokens['access_token'],
+            'refreshToken': tokens['refresh_token'],
+            'expiresAt': tokens['expires_at']
+        })
     return tokens['access_token']
 
 
+def refresh_access_token(athlete_id, refresh_token):
+    # One oauth round trip per athlete no matter how many requests noticed
+    # the expiry, the rest wait for it and reuse its result
+    def refresh():
+        tokens = get_token_cache().get(athlete_id)
+        if tokens is not None:
+            return tokens['accessToken']
+        return refresh_tokens(athlete_id, refresh_token)
+    return refresh_flight.do(athlete_id, refresh)
+
+
+def schedule_refresh(athlete_id, refresh_token):
+    # Marked before submitting, requests arriving while the refresh waits
+    # for a worker mustn't queue more of them
+    with scheduled_refreshes_lock:
+        if athlete_id in scheduled_refreshes or refresh_flight.in_flight(athlete_id):
+            return
+        scheduled_refreshes.add(athlete_id)
+
+    def refresh():
+        # Another refresh may have landed while this one was queued
+        tokens = get_token_cache().get(athlete_id)
+        if tokens is not None and not get_token_cache().needs_refresh(tokens):
+            return tokens['accessToken']
+        return refresh_tokens(athlete_id, tokens['refreshToken'] if tokens is not None else refresh_token)
+
+    def background_refresh():
+        try:
+            refresh_flight.do(athlete_id, refresh)
+        except Exception as e:
+            pprint(e)
+        finally:
+            with scheduled_refreshes_lock:
+                scheduled_refreshes.discard(athlete_id)
+    refresh_executor.submit(background_refresh)
+
+
 def fetch_tokens(athlete_id):
-    dynamodb = boto3.resource('dynamodb')
-    tokens_table = dynamodb.Table('srg-token-table')
+    tokens_table = get_table('srg-token-table')
     response = tokens_table.get_item(
         Key={
             'athleteId': athlete_id
@@ -141,16 +191,24 @@ def fetch_tokens_rs(athlete_id):
 
 
 def get_access_token_from_athlete_id(athlete_id):
-    tokens = fetch_tokens(athlete_id)
-
-    # Check to see if the token is expired
-    now = time.time()
-    later = tokens['expiresAt']
-
-    if now > later:
-        pprint('expired token!')
-        access_token = refresh_tokens(athlete_id, tokens['refreshToken'])
-        return access_token
-    else:
-        pprint('Token not yet expired!')
-        return tokens['accessToken']
+    token_cache = get_token_cache()
+    tokens = token_cache.get(athlete_id)
+    if tokens is None:
+        tokens = fetch_tokens(athlete_id)
+
+        # Check to see if the token is expired, or about to be
+        if not token_cache.is_fresh(tokens):
+            pprint('expired token!')
+            return refresh_access_token(athlete_id, tokens['refreshToken'])
+
+        tokens = {
+            'accessToken': tokens['accessToken'],
+            'refreshToken': tokens['refreshToken'],
+            'expiresAt': tokens['expiresAt']
+        }
+        token_cache.put(athlete_id, tokens)
+
+    # Refresh shortly before expiresAt so no request waits on oauth
+    if token_cache.needs_refresh(tokens):
+        schedule_refresh(athlete_id, tokens['refreshToken'])
+    return tokens['accessToken']
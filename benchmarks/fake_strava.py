@@ -0,0 +1,220 @@
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'testing_fixtures')
+
+SHORT_WINDOW_SECONDS = 15 * 60
+DAILY_WINDOW_SECONDS = 24 * 60 * 60
+NEWEST_START = 1700000000
+SPORTS = ['Run', 'Ride', 'Swim', 'Walk']
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'r') as file:
+        return json.load(file)
+
+
+def access_token_for(athlete_id):
+    # The fake reads the athlete back out of the bearer token
+    return f"bench-{athlete_id}"
+
+
+def refresh_token_for(athlete_id):
+    return f"bench-refresh-{athlete_id}"
+
+
+class FakeStrava:
+    def __init__(self, latency=0.05, jitter=0.02, pages=3, page_size=200, short_limit=600, daily_limit=30000, stream_points=2000, kudos=30):
+        self.latency = latency
+        self.jitter = jitter
+        self.pages = pages
+        self.page_size = page_size
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.stream_points = stream_points
+        self.kudos = kudos
+        self.summary = load_fixture('fetch_all_activities_strava.json')[0]
+        self.detail = load_fixture('fetch_individual_entry_strava.json')
+        self.lock = threading.Lock()
+        self.short_usage = 0
+        self.daily_usage = 0
+        self.short_resets_at = 0
+        self.daily_resets_at = 0
+        self.requests = Counter()
+        self.throttled = 0
+        self.server = None
+
+    @property
+    def activity_count(self):
+        return self.pages * self.page_size
+
+    def activity_ids(self, athlete_id):
+        return [athlete_id * 1000000 + index for index in range(self.activity_count)]
+
+    def summary_activity(self, athlete_id, index):
+        # Newest first, one a day, cycling through the synced sports
+        return {
+            **self.summary,
+            'id': athlete_id * 1000000 + index,
+            'athlete': {'id': athlete_id, 'resource_state': 1},
+            'name': f"Activity {index}",
+            'type': SPORTS[index % len(SPORTS)],
+            'sport_type': SPORTS[index % len(SPORTS)],
+            'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(NEWEST_START - index * 86400)),
+            'distance': round(1000 + index * 13.7 % 20000, 1),
+            'moving_time': 600 + index * 7 % 7200,
+            'elapsed_time': 660 + index * 7 % 7200,
+            'average_speed': round(1.5 + index % 9 * 0.5, 3),
+            'kudos_count': index % 12
+        }
+
+    def activities_page(self, athlete_id, page, per_page, after=None):
+        indexes = range(self.activity_count)
+        if after is not None:
+            indexes = [index for index in indexes if NEWEST_START -
+                       index * 86400 > after]
+        indexes = list(indexes)[(page - 1) * per_page:page * per_page]
+        return [self.summary_activity(athlete_id, index) for index in indexes]
+
+    def detail_activity(self, activity_id):
+        athlete_id, index = divmod(activity_id, 1000000)
+        return {**self.detail, **self.summary_activity(athlete_id, index)}
+
+    def streams(self):
+        points = range(self.stream_points)
+        return {
+            'latlng': {'data': [[40.0 + i / 10000, -105.0 - math.sin(i / 50) / 1000] for i in points], 'series_type': 'distance', 'original_size': self.stream_points, 'resolution': 'high'},
+            'time': {'data': list(points), 'series_type': 'distance', 'original_size': self.stream_points, 'resolution': 'high'},
+            'distance': {'data': [i * 2.5 for i in points], 'series_type': 'distance', 'original_size': self.stream_points, 'resolution': 'high'},
+            'heartrate': {'data': [120 + i % 40 for i in points], 'series_type': 'distance', 'original_size': self.stream_points, 'resolution': 'high'}
+        }
+
+    def spend(self):
+        # Same header format as Strava, short window first then daily
+        with self.lock:
+            now = time.time()
+            if now >= self.short_resets_at:
+                self.short_usage = 0
+                self.short_resets_at = (
+                    now // SHORT_WINDOW_SECONDS + 1) * SHORT_WINDOW_SECONDS
+            if now >= self.daily_resets_at:
+                self.daily_usage = 0
+                self.daily_resets_at = (
+                    now // DAILY_WINDOW_SECONDS + 1) * DAILY_WINDOW_SECONDS
+            allowed = self.short_usage < self.short_limit and self.daily_usage < self.daily_limit
+            if allowed:
+                self.short_usage += 1
+                self.daily_usage += 1
+            else:
+                self.throttled += 1
+            return allowed, {
+                'X-RateLimit-Limit': f"{self.short_limit},{self.daily_limit}",
+                'X-RateLimit-Usage': f"{self.short_usage},{self.daily_usage}"
+            }
+
+    def handle(self, method, path, query, athlete_id):
+        # Returns (route, status, body)
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['30'])[0])
+        if method == 'POST' and path == '/oauth/token':
+            return 'oauth', 200, {'access_token': access_token_for(athlete_id), 'refresh_token': refresh_token_for(athlete_id), 'expires_at': int(time.time()) + 6 * 3600, 'athlete': {'id': athlete_id}}
+        # The app lists from /activities, Strava documents /athlete/activities
+        if path in ('/activities', '/athlete/activities'):
+            after = query.get('after', [None])[0]
+            return 'activities', 200, self.activities_page(athlete_id, page, per_page, int(after) if after else None)
+        if path == '/athlete':
+            return 'athlete', 200, {'id': athlete_id, 'firstname': 'Bench', 'lastname': str(athlete_id)}
+        match = re.fullmatch(r'/athletes/(\d+)/stats/?', path)
+        if match:
+            return 'stats', 200, {'all_run_totals': {'count': self.activity_count}}
+        match = re.fullmatch(r'/activities/(\d+)(/(kudos|comments|streams))?', path)
+        if match:
+            activity_id, child = int(match.group(1)), match.group(3)
+            if child == 'streams':
+                return 'streams', 200, self.streams()
+            if child:
+                people = [{'firstname': f"Fan {i}", 'lastname': 'B.'}
+                          for i in range(self.kudos)]
+                return child, 200, people[(page - 1) * per_page:page * per_page]
+            return 'activity', 200, self.detail_activity(activity_id)
+        return 'unknown', 404, {'message': 'Record Not Found'}
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, method):
+                parsed = urlparse(self.path)
+                path = parsed.path.replace('/api/v3', '', 1)
+                query = parse_qs(parsed.query)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                query.update(parse_qs(body))
+                token = self.headers.get('Authorization') or query.get(
+                    'refresh_token', [''])[0]
+                athlete_id = token.rpartition('-')[2]
+                athlete_id = int(athlete_id) if athlete_id.isdigit() else 1
+                time.sleep(fake.latency + random.uniform(0, fake.jitter))
+                allowed, headers = fake.spend()
+                if allowed:
+                    route, status, payload = fake.handle(
+                        method, path, query, athlete_id)
+                else:
+                    route, status, payload = 'throttled', 429, {
+                        'message': 'Rate Limit Exceeded'}
+                with fake.lock:
+                    fake.requests[route] += 1
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_PUT(self):
+                self.respond('PUT')
+
+            def do_POST(self):
+                self.respond('POST')
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         name='fake-strava', daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api/v3"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'throttled': self.throttled,
+                'shortUsage': self.short_usage,
+                'dailyUsage': self.daily_usage
+            }
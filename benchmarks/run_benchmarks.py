@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+
+from fake_strava import FakeStrava, access_token_for, refresh_token_for  # noqa: E402
+
+TABLE_KEYS = {
+    'srg-token-table': ['athleteId'],
+    'srg-activities-table': ['athleteId', 'activityId'],
+    'srg-activity-streams-table': ['athleteId', 'activityId']
+}
+
+# (weight, label, method, build) where build(athlete_id, activity_id) gives
+# the path and keyword arguments for requests
+TRAFFIC = [
+    (20, 'GET /srg/allActivities', 'get',
+     lambda athlete, activity: (f"/srg/allActivities?srg_athlete_id={athlete}", {})),
+    (10, 'GET /srg/allActivities?limit', 'get',
+     lambda athlete, activity: (f"/srg/allActivities?srg_athlete_id={athlete}&limit=50&fields=name,type,distance,start_date", {})),
+    (15, 'GET /srg/generalIndividualEntry', 'get',
+     lambda athlete, activity: (f"/srg/generalIndividualEntry/{athlete}/{activity}?details=laps", {})),
+    (10, 'GET /srg/getUserSettings', 'get',
+     lambda athlete, activity: (f"/srg/getUserSettings?srg_athlete_id={athlete}", {})),
+    (10, 'GET /srg/report', 'get',
+     lambda athlete, activity: (f"/srg/report?srg_athlete_id={athlete}&sort=pace&period=month", {})),
+    (5, 'GET /srg/individualEntry', 'get',
+     lambda athlete, activity: (f"/srg/individualEntry/{activity}?srg_athlete_id={athlete}", {})),
+    (5, 'GET /srg/entryKudos', 'get',
+     lambda athlete, activity: (f"/srg/entryKudos/{activity}?srg_athlete_id={athlete}", {})),
+    (5, 'GET /srg/activityStream', 'get',
+     lambda athlete, activity: (f"/srg/activityStream/{activity}?srg_athlete_id={athlete}&keys=latlng,time&points=500", {})),
+    (3, 'POST /srg/saveUserSettings', 'post',
+     lambda athlete, activity: (f"/srg/saveUserSettings?srg_athlete_id={athlete}", {'json': {'defaultSport': random.choice(['Run', 'Ride']), 'defaultFormat': 'Imperial', 'defaultDate': 'Week', 'darkMode': True}})),
+    (2, 'PUT /srg/activityUpdate', 'put',
+     lambda athlete, activity: (f"/srg/activityUpdate?srg_athlete_id={athlete}&entry_id={activity}&name=Bench&description=Run", {}))
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Drive the app against a fake Strava and moto DynamoDB and report latency per route')
+    parser.add_argument('--athletes', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=3,
+                        help='Strava activity pages per athlete')
+    parser.add_argument('--page-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Fake Strava base latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--short-limit', type=int, default=600)
+    parser.add_argument('--daily-limit', type=int, default=30000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20,
+                        help='Seconds of mixed traffic')
+    parser.add_argument('--waitress-threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dynamodb-endpoint',
+                        help='Use e.g. DynamoDB Local at this URL instead of moto')
+    parser.add_argument('--json', help='Also write the results to this file')
+    return parser.parse_args()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples, elapsed):
+    summary = {}
+    for label, (latencies, errors) in sorted(samples.items()):
+        ordered = sorted(latencies)
+        summary[label] = {
+            'requests': len(ordered),
+            'errors': errors,
+            'p50': percentile(ordered, 0.50),
+            'p95': percentile(ordered, 0.95),
+            'p99': percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else 0.0,
+            'throughput': len(ordered) / elapsed if elapsed else 0.0
+        }
+    return summary
+
+
+def print_table(title, summary):
+    print(f"\n{title}")
+    print(f"{'route':<36}{'reqs':>7}{'errs':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'req/s':>8}")
+    for label, row in summary.items():
+        print(f"{label:<36}{row['requests']:>7}{row['errors']:>6}{row['p50'] * 1000:>9.1f}{row['p95'] * 1000:>9.1f}"
+              f"{row['p99'] * 1000:>9.1f}{row['max'] * 1000:>9.1f}{row['throughput']:>8.1f}")
+
+
+def create_tables():
+    import boto3
+    dynamodb = boto3.resource('dynamodb')
+    for table_name, keys in TABLE_KEYS.items():
+        dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': key, 'KeyType': key_type}
+                       for key, key_type in zip(keys, ['HASH', 'RANGE'])],
+            AttributeDefinitions=[
+                {'AttributeName': key, 'AttributeType': 'S'} for key in keys],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+
+def seed_tokens(athlete_ids):
+    from dynamo_utilities import get_table
+    table = get_table('srg-token-table')
+    for athlete_id in athlete_ids:
+        table.put_item(Item={
+            'athleteId': str(athlete_id),
+            'accessToken': access_token_for(athlete_id),
+            'refreshToken': refresh_token_for(athlete_id),
+            'expiresAt': int(time.time()) + 6 * 3600,
+            'defaultSport': 'Run',
+            'defaultFormat': 'Imperial',
+            'defaultDate': 'Week',
+            'darkMode': False
+        })
+
+
+def start_app(threads):
+    from waitress.server import create_server
+    from strava import app
+    server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+    threading.Thread(target=server.run, name='bench-waitress',
+                     daemon=True).start()
+    return server, f"http://127.0.0.1:{server.effective_port}"
+
+
+def run_sync(base_url, athlete_ids, full_resync):
+    # Times the addAllActivities job end to end, submit until it finishes
+    import requests
+    session = requests.Session()
+    results = {}
+    started = time.perf_counter()
+    for athlete_id in athlete_ids:
+        session.post(f"{base_url}/srg/addAllActivities?srg_athlete_id={athlete_id}&full_resync={str(full_resync).lower()}")
+    for athlete_id in athlete_ids:
+        while True:
+            status = session.get(
+                f"{base_url}/srg/syncStatus?srg_athlete_id={athlete_id}").json()
+            if status['status'] in ('succeeded', 'failed'):
+                break
+            time.sleep(0.05)
+        results[str(athlete_id)] = {
+            'status': status['status'],
+            'seconds': status['updatedAt'] - status['createdAt'],
+            **status['progress']
+        }
+    elapsed = time.perf_counter() - started
+    fetched = sum(result.get('activitiesFetched', 0)
+                  for result in results.values())
+    return {
+        'seconds': elapsed,
+        'activitiesFetched': fetched,
+        'activitiesPerSecond': fetched / elapsed if elapsed else 0.0,
+        'athletes': results
+    }
+
+
+def run_traffic(base_url, fake, athlete_ids, concurrency, duration, seed):
+    import requests
+    weights = [weight for weight, *_ in TRAFFIC]
+    samples = defaultdict(lambda: ([], 0))
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        session = requests.Session()
+        etags = {}
+        while time.perf_counter() < deadline:
+            _, label, method, build = rng.choices(TRAFFIC, weights)[0]
+            athlete_id = rng.choice(athlete_ids)
+            activity_id = rng.choice(fake.activity_ids(athlete_id))
+            path, kwargs = build(athlete_id, activity_id)
+            headers = {}
+            # Browsers revalidate what they already have
+            if method == 'get' and path in etags:
+                headers['If-None-Match'] = etags[path]
+            started = time.perf_counter()
+            try:
+                response = getattr(session, method)(
+                    base_url + path, headers=headers, **kwargs)
+                response.content
+                failed = response.status_code >= 400
+                if response.headers.get('ETag'):
+                    etags[path] = response.headers['ETag']
+            except requests.RequestException:
+                failed = True
+            latency = time.perf_counter() - started
+            with lock:
+                latencies, errors = samples[label]
+                latencies.append(latency)
+                samples[label] = (latencies, errors + failed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    everything = [latency for latencies,
+                  _ in samples.values() for latency in latencies]
+    summary = summarize(samples, elapsed)
+    summary['ALL'] = summarize(
+        {'ALL': (everything, sum(errors for _, errors in samples.values()))}, elapsed)['ALL']
+    return summary
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    fake = FakeStrava(latency=args.latency, jitter=args.jitter, pages=args.pages, page_size=args.page_size,
+                      short_limit=args.short_limit, daily_limit=args.daily_limit)
+    fake_url = fake.start()
+
+    # The app reads these at import time, so set them before importing it
+    os.environ.update({
+        'STRAVA_API_URL': fake_url,
+        'STRAVA_RATE_LIMIT_SHORT': str(args.short_limit),
+        'STRAVA_RATE_LIMIT_DAILY': str(args.daily_limit),
+        'WAITRESS_THREADS': str(args.waitress_threads),
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_DEFAULT_REGION': os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+    })
+    athlete_ids = list(range(1, args.athletes + 1))
+    if args.dynamodb_endpoint:
+        # moto serializes every call in Python, a real engine shows what
+        # the app itself costs
+        os.environ['AWS_ENDPOINT_URL_DYNAMODB'] = args.dynamodb_endpoint
+        backend = nullcontext()
+    else:
+        from moto import mock_dynamodb
+        backend = mock_dynamodb()
+
+    with backend:
+        create_tables()
+        seed_tokens(athlete_ids)
+        server, base_url = start_app(args.waitress_threads)
+        try:
+            results = {'config': vars(args)}
+            results['fullSync'] = run_sync(base_url, athlete_ids, True)
+            results['incrementalSync'] = run_sync(
+                base_url, athlete_ids, False)
+            results['routes'] = run_traffic(
+                base_url, fake, athlete_ids, args.concurrency, args.duration, args.seed)
+            results['strava'] = fake.stats()
+        finally:
+            # Let in-flight tasks finish before their trigger fd goes away
+            server.task_dispatcher.shutdown()
+            server.close()
+            fake.stop()
+
+    for name in ['fullSync', 'incrementalSync']:
+        sync = results[name]
+        print(f"{name}: {sync['activitiesFetched']} activities in {sync['seconds']:.2f}s "
+              f"({sync['activitiesPerSecond']:.1f}/s)")
+    print_table(f"Mixed traffic, {args.concurrency} clients for {args.duration:g}s",
+                results['routes'])
+    print(f"\nFake Strava: {json.dumps(results['strava'])}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        # failure_threshold consecutive failures open the circuit, after
+        # reset_timeout one probe call is let through to test the waters
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+        self.short_circuited = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def cancel(self):
+        # An allowed call that never reached Strava, e.g. out of budget
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.probing = False
+
+    def retry_after(self):
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(0, int(self.opened_at + self.reset_timeout - time.time()) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutiveFailures': self.failures,
+                'failureThreshold': self.failure_threshold,
+                'resetTimeout': self.reset_timeout,
+                'openedAt': int(self.opened_at) if self.opened_at else None,
+                'timesOpened': self.opened,
+                'shortCircuited': self.short_circuited
+            }
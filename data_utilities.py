@@ -1,22 +1,71 @@
-import boto3
+import calendar
 import json
-import requests
-from pprint import pprint
+import os
+import random
+import time
+import uuid
 from auth_utilities import get_access_token_from_athlete_id
-from flask import Blueprint, make_response, request, jsonify
+from token_cache import get_token_cache
+from dynamo_utilities import get_resource, get_table
+from jobs import get_job_registry
+from activity_codec import BLOB_ATTRIBUTES, encode_blob, decode_blob, decode_item_blobs, encode_stream, decode_stream
+from downsampling import downsample_streams
+from write_behind import get_write_behind_queue
+from data_version import bump_data_version, conditional_response
+from metrics import get_metrics
+from strava_client import get_strava_client, STRAVA_API_URL, StravaUnavailableError
+from rate_limiter import RateLimitError, INTERACTIVE, BULK
+from flask import Blueprint, Response, current_app, make_response, request, jsonify, stream_with_context
 from decimal import Decimal
 from urllib.parse import quote
 from boto3.dynamodb.types import TypeSerializer
-from botocore.exceptions import ClientError
 from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain
 
 data_controller_bp = Blueprint('data_controller', __name__)
 
-
-class RateLimitError(Exception):
+STRAVA_PAGE_SIZE = 200
+# Scalar columns the report table needs, leaves out the large JSON strings
+# written for cached individual entries
+SUMMARY_FIELDS = [
+    'name', 'type', 'start_date', 'distance', 'moving_time', 'elapsed_time',
+    'average_speed', 'max_speed', 'elev_high', 'elev_low',
+    'total_elevation_gain', 'average_heartrate', 'max_heartrate',
+    'location_city', 'location_state', 'location_country',
+    'achievement_count', 'kudos_count', 'comment_count', 'pr_count',
+    'description', 'gearName', 'shoeId', 'deviceName', 'primaryPhotoUrl',
+    'individualActivityCached'
+]
+STREAM_KEYS = [
+    'latlng', 'time', 'distance', 'altitude', 'heartrate', 'cadence',
+    'watts', 'temp', 'moving', 'grade_smooth', 'velocity_smooth'
+]
+BATCH_GET_SIZE = 100
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_ATTEMPTS = 8
+
+
+# Shared by requests that fan out to Strava
+strava_executor = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix='srg-strava')
+# Shared by syncs and deletes writing batches in parallel. Its threads live
+# on, and so do the DynamoDB resources each one builds
+dynamodb_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('DYNAMODB_WORKERS', 4)), thread_name_prefix='srg-dynamodb')
+
+
+class UnprocessedItemsError(Exception):
     pass
 
 
+class StravaError(Exception):
+    # Strava answered with an error body, status_code is what it sent
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
 @data_controller_bp.route('/srg/activityStream/<entry_id>', methods=['GET'])
 def route_get_activity_stream(entry_id):
     return get_activity_stream(entry_id)
@@ -24,20 +73,90 @@ def route_get_activity_stream(entry_id):
 
 def get_activity_stream(entry_id):
     srg_athlete_id = request.args.get('srg_athlete_id')
-    access_token = get_access_token_from_athlete_id(srg_athlete_id)
-    activity_stream = get_activity_stream_req(entry_id, access_token)
+    keys = parse_stream_keys(request.args.get('keys'))
+    points = request.args.get('points', type=int)
+    refresh = request.args.get('refresh', 'false').lower() == 'true'
+
+    item = fetch_activity_stream_item_req(srg_athlete_id, entry_id)
+    activity_stream = None if refresh else cached_activity_stream(item, keys)
+    if activity_stream is None:
+        # The item holds one map of streams, ask for what's already cached as
+        # well so the write doesn't evict another view's keys
+        cached_keys = list(item['streams']) if item else []
+        fetch_keys = keys + [key for key in cached_keys if key not in keys]
+        try:
+            access_token = get_access_token_from_athlete_id(srg_athlete_id)
+            activity_stream = get_activity_stream_req(
+                entry_id, access_token, fetch_keys)
+        except StravaUnavailableError:
+            # A refresh that can't reach Strava still gets the stored copy
+            activity_stream = cached_activity_stream(
+                item, keys) if refresh else None
+            if activity_stream is None:
+                raise
+            return activity_stream
+        # Errors come back as a message object instead of keyed streams
+        if not all(isinstance(stream, dict) and 'data' in stream for stream in activity_stream.values()):
+            return activity_stream
+        get_write_behind_queue().enqueue(
+            ('activityStream', srg_athlete_id, entry_id), save_activity_stream_req, srg_athlete_id, entry_id, activity_stream)
+    activity_stream = {key: stream for key,
+                       stream in activity_stream.items() if key in keys}
+    if points and activity_stream:
+        activity_stream = downsample_streams(activity_stream, points)
     return activity_stream
 
 
-def get_activity_stream_req(entry_id, access_token):
-    url = f"https://www.strava.com/api/v3/activities/{entry_id}/streams?keys=latlng&key_by_type=true"
-    r = requests.get(
-        url, headers={"Authorization": f"Bearer { access_token }"}
-    )
+def parse_stream_keys(keys):
+    if keys is None:
+        return ['latlng']
+    return [key.strip() for key in keys.split(',') if key.strip() in STREAM_KEYS]
+
+
+def get_activity_stream_req(entry_id, access_token, keys=None):
+    keys = ','.join(keys or ['latlng'])
+    url = f"{STRAVA_API_URL}/activities/{entry_id}/streams?keys={keys}&key_by_type=true"
+    # Long activities make for large stream payloads
+    r = get_strava_client().get(url, access_token=access_token, deadline=float(
+        os.environ.get('STRAVA_STREAM_DEADLINE', 20)))
     r = r.json()
     return r
 
 
+def fetch_activity_stream_item_req(srg_athlete_id, entry_id):
+    streams_table = get_table('srg-activity-streams-table')
+    return streams_table.get_item(
+        Key={'athleteId': srg_athlete_id, 'activityId': entry_id}
+    ).get('Item')
+
+
+def cached_activity_stream(item, keys):
+    if not item or not all(key in item['streams'] for key in keys):
+        return None
+    return {key: {
+        'data': decode_stream(key, item['streams'][key]['data']),
+        'series_type': item['streams'][key].get('seriesType'),
+        'original_size': item['streams'][key].get('originalSize'),
+        'resolution': item['streams'][key].get('resolution')
+    } for key in keys}
+
+
+def save_activity_stream_req(srg_athlete_id, entry_id, activity_stream):
+    streams_table = get_table('srg-activity-streams-table')
+    streams_table.put_item(Item={
+        'athleteId': srg_athlete_id,
+        'activityId': entry_id,
+        'streams': {key: {
+            'data': encode_stream(key, stream['data']),
+            'seriesType': stream.get('series_type'),
+            'originalSize': stream.get('original_size'),
+            'resolution': stream.get('resolution')
+        } for key, stream in activity_stream.items()},
+        'cachedAt': int(time.time())
+    })
+    return 'ok'
+
+
 @data_controller_bp.route('/srg/getUserSettings', methods=['GET'])
 def route_get_user_settings():
     try:
@@ -50,12 +169,11 @@ def route_get_user_settings():
 
 def get_user_settings():
     srg_athlete_id = request.args.get('srg_athlete_id')
-    return get_user_settings_req(srg_athlete_id)
+    return conditional_response(srg_athlete_id, lambda: get_user_settings_req(srg_athlete_id))
 
 
 def get_user_settings_req(athlete_id):
-    dynamodb = boto3.resource('dynamodb')
-    tokens_table = dynamodb.Table('srg-token-table')
+    tokens_table = get_table('srg-token-table')
     response = tokens_table.get_item(
         Key={
             'athleteId': athlete_id
@@ -91,22 +209,23 @@ def save_user_settings():
 
 
 def save_user_settings_req(srg_athlete_id, default_sport, default_format, default_date, dark_mode):
-    dynamodb = boto3.resource('dynamodb')
     key = {'athleteId': srg_athlete_id}
-    update_expression = 'SET #defaultSportAttr = :defaultSportValue, #defaultFormatAttr = :defaultFormatValue, #defaultDateAttr = :defaultDateValue, #darkModeAttr = :darkModeValue'
+    update_expression = 'SET #defaultSportAttr = :defaultSportValue, #defaultFormatAttr = :defaultFormatValue, #defaultDateAttr = :defaultDateValue, #darkModeAttr = :darkModeValue, #dataVersionAttr = :dataVersionValue'
     expression_attribute_names = {
         '#defaultSportAttr': 'defaultSport',
         '#defaultFormatAttr': 'defaultFormat',
         '#defaultDateAttr': 'defaultDate',
-        '#darkModeAttr': 'darkMode'
+        '#darkModeAttr': 'darkMode',
+        '#dataVersionAttr': 'dataVersion'
     }
     expression_attribute_values = {
         ':defaultSportValue': default_sport,
         ':defaultFormatValue': default_format,
         ':defaultDateValue': default_date,
-        ':darkModeValue': dark_mode
+        ':darkModeValue': dark_mode,
+        ':dataVersionValue': uuid.uuid4().hex
     }
-    table = dynamodb.Table('srg-token-table')
+    table = get_table('srg-token-table')
     table.update_item(
         Key=key,
         UpdateExpression=update_expression,
@@ -123,15 +242,26 @@ def route_fetch_entry_kudoers(entryId):
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 429)
         return response
+    except StravaError as e:
+        error_message = str(e)
+        response = make_response(jsonify({'error': error_message}),
+                                 e.status_code if e.status_code >= 400 else 502)
+        return response
 
 
 def update_cached_kudos_comments(srg_athlete_id, entry_id, kudos, comments):
+    # Counting an error body's keys would store nonsense counts
+    if not isinstance(kudos, list) or not isinstance(comments, list):
+        return 'dynamo skipped'
     kudos_len = len(kudos)
     comment_len = len(comments)
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
+    table = get_table('srg-activities-table')
     key = {'athleteId': srg_athlete_id, 'activityId': entry_id}
+    # A read is cheaper than a write, skip the write when nothing changed
+    stored = table.get_item(
+        Key=key, ProjectionExpression='kudos_count, comment_count').get('Item', {})
+    if stored.get('kudos_count') == kudos_len and stored.get('comment_count') == comment_len:
+        return 'dynamo unchanged'
     update_expression = 'SET #kudosCountAttr = :kudosCountValue, #commentCountAttr = :commentCountValue'
     expression_attribute_names = {
         '#kudosCountAttr': 'kudos_count',
@@ -146,47 +276,68 @@ def update_cached_kudos_comments(srg_athlete_id, entry_id, kudos, comments):
         UpdateExpression=update_expression,
         ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
     )
+    bump_data_version(srg_athlete_id)
     return 'dynamo updated'
 
 
 def fetch_entry_kudoers(entry_id):
     srg_athlete_id = request.args.get('srg_athlete_id')
     access_token = get_access_token_from_athlete_id(srg_athlete_id)
-    comments = fetch_entry_comments_req(entry_id, access_token)
-    kudos = fetch_entry_kudoers_req(entry_id, access_token)
-    update_cached_kudos_comments(srg_athlete_id, entry_id, kudos, comments)
+    # Both lists at once, the endpoint waits for the slower one only
+    comments = strava_executor.submit(
+        fetch_entry_comments_req, entry_id, access_token)
+    kudos = strava_executor.submit(
+        fetch_entry_kudoers_req, entry_id, access_token)
+    comments, kudos = comments.result(), kudos.result()
+    get_write_behind_queue().enqueue(
+        ('kudosComments', srg_athlete_id, entry_id), update_cached_kudos_comments, srg_athlete_id, entry_id, kudos, comments)
     return {'comments': comments, 'kudos': kudos}
 
 
+def fetch_all_pages_strava_req(url, access_token):
+    results = []
+    page = 1
+    while True:
+        response = get_strava_client().get(url, access_token=access_token, params={
+            'page': page, 'per_page': STRAVA_PAGE_SIZE})
+        r = response.json()
+        if 'errors' in r and any(error.get('code') == 'exceeded' for error in r['errors']):
+            raise RateLimitError('Rate Limit Exceeded')
+        # Half a list is as wrong as none, never hand back the pages so far
+        if not isinstance(r, list):
+            raise StravaError(r.get('message', 'Strava Error') if isinstance(
+                r, dict) else 'Strava Error', response.status_code)
+        results.extend(r)
+        if len(r) < STRAVA_PAGE_SIZE:
+            return results
+        page += 1
+
+
 def fetch_entry_kudoers_req(entry_id, access_token):
-    url = f"https://www.strava.com/api/v3/activities/{entry_id}/kudos"
-    r = requests.get(
-        url, headers={"Authorization": f"Bearer { access_token }"})
-    r = r.json()
-    if 'errors' in r and any(error.get('code') == 'exceeded' for error in r['errors']):
-        raise RateLimitError('Rate Limit Exceeded')
-    return r
+    url = f"{STRAVA_API_URL}/activities/{entry_id}/kudos"
+    return fetch_all_pages_strava_req(url, access_token)
 
 
 def fetch_entry_comments_req(entry_id, access_token):
-    url = f"https://www.strava.com/api/v3/activities/{entry_id}/comments"
-    r = requests.get(
-        url, headers={"Authorization": f"Bearer { access_token }"})
-    r = r.json()
-
-    if 'errors' in r and any(error.get('code') == 'exceeded' for error in r['errors']):
-        raise RateLimitError('Rate Limit Exceeded')
-    return r
+    url = f"{STRAVA_API_URL}/activities/{entry_id}/comments"
+    return fetch_all_pages_strava_req(url, access_token)
 
 
 @data_controller_bp.route('/srg/generalIndividualEntry/<athlete_id>/<activity_id>', methods=['GET'])
 def route_fetch_general_individual_entry(athlete_id, activity_id):
-    return fetch_general_individual_entry(athlete_id, activity_id)
+    details = parse_details(request.args.get('details'))
+    return conditional_response(athlete_id, lambda: fetch_general_individual_entry(athlete_id, activity_id, details))
+
 
+def parse_details(details):
+    # Which of the large blobs to decode, all of them unless asked otherwise
+    if details is None:
+        return list(BLOB_ATTRIBUTES.keys())
+    return [detail.strip() for detail in details.split(',') if detail.strip() in BLOB_ATTRIBUTES]
 
-def fetch_general_individual_entry(athlete_id, activity_id):
-    dynamodb = boto3.resource('dynamodb')
-    activities_table = dynamodb.Table('srg-activities-table')
+
+def fetch_general_individual_entry(athlete_id, activity_id, details=None):
+    activities_table = get_table('srg-activities-table')
     response = activities_table.query(
         KeyConditionExpression="#athlete_id = :athlete_id AND #activity_id = :activity_id",
         ExpressionAttributeNames={
@@ -198,18 +349,26 @@ def fetch_general_individual_entry(athlete_id, activity_id):
             ":activity_id": activity_id,
         }
     )
-    response = response['Items'][0]
+    return individual_entry_from_item(response['Items'][0], details)
+
+
+def individual_entry_from_item(response, details=None):
+    if details is None:
+        details = list(BLOB_ATTRIBUTES.keys())
+    # Blobs are only decoded when asked for, the rest are left out entirely
+    blobs = {detail: decode_blob(response.get(BLOB_ATTRIBUTES[detail]))
+             for detail in details}
+    response = {key: value for key, value in response.items()
+                if key not in BLOB_ATTRIBUTES.values()}
     new_response = {**response,
                     "id": int(response.get('activityId')),
-                    "best_efforts": json.loads(response.get('bestEfforts')),
-                    "segment_efforts": json.loads(response.get('segmentEfforts')),
+                    **blobs,
                     "gear": {
                         "name": response.get('gearName')
                     },
                     "map": {
                         "polyline": response.get('mapPolyline')
                     },
-                    "laps": json.loads(response.get("laps")),
                     "device_name": response.get('deviceName'),
                     "photos": {
                         "count": 1,
@@ -235,24 +394,74 @@ def fetch_general_individual_entry(athlete_id, activity_id):
 
 @data_controller_bp.route('/srg/individualEntry/<entryId>', methods=["GET"])
 def route_fetch_individual_entry(entryId):
-    return fetch_individual_entry(entryId)
+    try:
+        return fetch_individual_entry(entryId)
+    except RateLimitError as e:
+        error_message = str(e)
+        response = make_response(jsonify({'error': error_message}), 429)
+        return response
+
+
+def fetch_individual_entry_response_req(entryId, access_token, priority=INTERACTIVE):
+    url = f"{STRAVA_API_URL}/activities/{entryId}?include_all_efforts=true"
+    return get_strava_client().get(url, access_token=access_token, priority=priority)
 
 
-def fetch_individual_entry_req(entryId, access_token):
-    url = f"https://www.strava.com/api/v3/activities/{entryId}?include_all_efforts=true"
-    r = requests.get(
-        url, headers={"Authorization": f"Bearer { access_token }"})
+def fetch_individual_entry_req(entryId, access_token, priority=INTERACTIVE):
+    r = fetch_individual_entry_response_req(entryId, access_token, priority)
     r = r.json()
     return r
 
 
+def fetch_cached_individual_entry_req(srg_athlete_id, entry_id, max_age):
+    activities_table = get_table('srg-activities-table')
+    item = activities_table.get_item(
+        Key={'athleteId': srg_athlete_id, 'activityId': entry_id}
+    ).get('Item')
+    if not item or not item.get('individualActivityCached'):
+        return None
+    # Rows cached before the timestamp was recorded count as stale, unless
+    # any age will do (max_age None)
+    cached_at = item.get('individualActivityCachedAt')
+    if max_age is not None and (cached_at is None or time.time() - float(cached_at) > max_age):
+        return None
+    return individual_entry_from_item(item)
+
+
 def fetch_individual_entry(entry_id):
     try:
         srg_athlete_id = request.args.get('srg_athlete_id')
-        access_token = get_access_token_from_athlete_id(srg_athlete_id)
-        data = fetch_individual_entry_req(entry_id, access_token)
-        upload_individual_entry_data_to_db(data, srg_athlete_id, entry_id)
+        refresh = request.args.get('refresh', 'false').lower() == 'true'
+        if not refresh:
+            max_age = float(os.environ.get(
+                'INDIVIDUAL_ENTRY_MAX_AGE', 24 * 60 * 60))
+            cached = fetch_cached_individual_entry_req(
+                srg_athlete_id, entry_id, max_age)
+            if cached is not None:
+                return cached
+        try:
+            access_token = get_access_token_from_athlete_id(srg_athlete_id)
+            response = fetch_individual_entry_response_req(
+                entry_id, access_token)
+        except StravaUnavailableError:
+            # While Strava is degraded a stale copy beats an error page
+            cached = fetch_cached_individual_entry_req(
+                srg_athlete_id, entry_id, None)
+            if cached is None:
+                raise
+            return cached
+        if response.status_code == 429:
+            raise RateLimitError('Rate Limit Exceeded')
+        data = response.json()
+        # Only a real activity is cached, an error body would be served as
+        # one for the whole max age
+        if response.status_code != 200 or not isinstance(data, dict) or 'errors' in data or 'id' not in data:
+            return data
+        get_write_behind_queue().enqueue(
+            ('individualEntry', srg_athlete_id, entry_id), upload_individual_entry_data_to_db, data, srg_athlete_id, entry_id)
         return data
+    except (StravaUnavailableError, RateLimitError):
+        raise
     except Exception as e:
         print("Exception")
         return ('<html><style>body { background-color: ivory }</style><div>Individual Entry Fetch Error:</div> <p>%s</p></html>' % e)
@@ -261,28 +470,27 @@ def fetch_individual_entry(entry_id):
 def upload_individual_entry_data_to_db(data, srg_athlete_id, entry_id):
     # data section #
     activity_description = data.get('description', '')
-    best_efforts = json.dumps(data.get('best_efforts', []))
+    best_efforts = encode_blob(data.get('best_efforts', []))
     device_name = data.get('device_name', '')
     gear_name = data.get('gear', {}).get('name', '')
-    laps = json.dumps(data.get('laps', []))
+    laps = encode_blob(data.get('laps', []))
     map_polyline = data.get('map', {}).get('polyline', '')
     primary_photo_url = data.get('photos', {}).get('primary', {})
     if primary_photo_url is not None:
         primary_photo_url = primary_photo_url.get('urls', {}).get('600', '')
     else:
         primary_photo_url = ''
-    segment_efforts = json.dumps(data.get('segment_efforts', []))
+    segment_efforts = encode_blob(data.get('segment_efforts', []))
     # data captured in memory#
 
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
+    table = get_table('srg-activities-table')
     key = {'athleteId': srg_athlete_id, 'activityId': entry_id}
 
-    update_expression = 'SET #indActivityHasBeenCachedAttr = :indActivityHasBeenCachedValue, #primaryPhotoAttr = :primaryPhotoValue, #activityDescriptionAttr = :activityDescriptionValue, #deviceNameAttr = :deviceNameValue, #gearNameAttr = :gearNameValue, #mapPolylineAttr = :mapPolylineValue, #lapsAttr = :lapsValue, #bestEffortsAttr = :bestEffortsValue, #segmentEffortsAttr = :segmentEffortsValue'
+    update_expression = 'SET #indActivityHasBeenCachedAttr = :indActivityHasBeenCachedValue, #indActivityCachedAtAttr = :indActivityCachedAtValue, #primaryPhotoAttr = :primaryPhotoValue, #activityDescriptionAttr = :activityDescriptionValue, #deviceNameAttr = :deviceNameValue, #gearNameAttr = :gearNameValue, #mapPolylineAttr = :mapPolylineValue, #lapsAttr = :lapsValue, #bestEffortsAttr = :bestEffortsValue, #segmentEffortsAttr = :segmentEffortsValue'
 
     expression_attribute_names = {
         '#indActivityHasBeenCachedAttr': 'individualActivityCached',
+        '#indActivityCachedAtAttr': 'individualActivityCachedAt',
         '#primaryPhotoAttr': 'primaryPhotoUrl',
         '#activityDescriptionAttr': 'description',
         '#deviceNameAttr': 'deviceName',
@@ -295,6 +503,7 @@ def upload_individual_entry_data_to_db(data, srg_athlete_id, entry_id):
 
     expression_attribute_values = {
         ':indActivityHasBeenCachedValue': True,
+        ':indActivityCachedAtValue': int(time.time()),
         ':primaryPhotoValue': primary_photo_url,
         ':activityDescriptionValue': activity_description,
         ':deviceNameValue': device_name,
@@ -309,6 +518,7 @@ def upload_individual_entry_data_to_db(data, srg_athlete_id, entry_id):
         UpdateExpression=update_expression,
         ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
     )
+    bump_data_version(srg_athlete_id)
     return 'ok'
 
 
@@ -316,47 +526,183 @@ def upload_individual_entry_data_to_db(data, srg_athlete_id, entry_id):
 @data_controller_bp.route('/srg/allActivities', methods=["GET"])
 def route_fetch_all_activities():
     try:
-        return fetch_all_activities()
+        return conditional_response(request.args.get('srg_athlete_id'), fetch_all_activities)
+    except ValueError as e:
+        error_message = str(e)
+        response = make_response(jsonify({'error': error_message}), 400)
+        return response
     except Exception as e:
         print(
             "Exception when calling ActivitiesApi -> getLoggedInAthleteActivities: %s\n" % e)
         return ('Fetch All Activities Error: %s\n' % e)
 
 
-def fetch_all_activities_strava_req(access_token, page):
-    url = "https://www.strava.com/api/v3/activities"
-    r = requests.get(
+def fetch_activities_page_strava_req(access_token, page, priority=INTERACTIVE, after=None):
+    url = f"{STRAVA_API_URL}/activities"
+    params = {'page': page, 'per_page': STRAVA_PAGE_SIZE}
+    if after is not None:
+        params['after'] = after
+    r = get_strava_client().get(
         url,
-        headers={"Authorization": f"Bearer { access_token }"},
-        params={'page': page, 'per_page': 200}
+        access_token=access_token,
+        priority=priority,
+        params=params
     )
     r = r.json()
     if 'errors' in r and any(error.get('code') == 'exceeded' for error in r['errors']):
         raise RateLimitError('Rate Limit Exceeded')
-    if len(r) == 200:
-        return r + fetch_all_activities_strava_req(access_token, page + 1)
     return r
 
 
-def fetch_all_activities_req(srg_athlete_id):
-    dynamodb = boto3.resource('dynamodb')
-    activities_table = dynamodb.Table('srg-activities-table')
-    response = activities_table.query(
-        KeyConditionExpression="#athlete_id = :athlete_id",
-        ExpressionAttributeNames={
+def iter_activity_pages_strava(access_token, page=1, priority=INTERACTIVE, after=None, prefetch=None):
+    # Keeps the next `prefetch` pages in flight while the caller works on the
+    # current one, stopping at the first short page
+    if prefetch is None:
+        prefetch = int(os.environ.get('STRAVA_PAGE_PREFETCH', 3))
+    # The first page goes out alone, incremental syncs and small accounts
+    # rarely need a second one
+    r = fetch_activities_page_strava_req(access_token, page, priority, after)
+    yield r
+    if len(r) < STRAVA_PAGE_SIZE:
+        return
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    in_flight = deque()
+    next_page = page + 1
+    try:
+        while True:
+            while len(in_flight) < prefetch:
+                in_flight.append(executor.submit(
+                    fetch_activities_page_strava_req, access_token, next_page, priority, after))
+                next_page += 1
+            r = in_flight.popleft().result()
+            yield r
+            if len(r) < STRAVA_PAGE_SIZE:
+                return
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def fetch_all_activities_strava_req(access_token, page, priority=INTERACTIVE, after=None):
+    activities = []
+    for r in iter_activity_pages_strava(access_token, page, priority, after):
+        activities.extend(r)
+    return activities
+
+
+def projection_kwargs(fields):
+    names = {f"#p{i}": field for i, field in enumerate(
+        dict.fromkeys(['athleteId', 'activityId', *fields]))}
+    return {
+        'ProjectionExpression': ', '.join(names.keys()),
+        'ExpressionAttributeNames': names
+    }
+
+
+def parse_fields(fields):
+    # None means every attribute, no parameter means the report summary
+    if fields is None:
+        return SUMMARY_FIELDS
+    if fields == 'all':
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    invalid = [field for field in fields if not field.replace('_', '').isalnum()]
+    if invalid:
+        raise ValueError(f"Invalid fields: {', '.join(invalid)}")
+    return fields
+
+
+def iter_activity_pages_req(srg_athlete_id, cursor=None, page_size=None, fields=None, table_name='srg-activities-table'):
+    # Follows LastEvaluatedKey so nothing past DynamoDB's 1 MB page is dropped
+    activities_table = get_table(table_name)
+    query_kwargs = {
+        'KeyConditionExpression': "#athlete_id = :athlete_id",
+        'ExpressionAttributeNames': {
             "#athlete_id": "athleteId",
         },
-        ExpressionAttributeValues={
+        'ExpressionAttributeValues': {
             ":athlete_id": srg_athlete_id,
         }
-    )
-    return response['Items']
+    }
+    if fields:
+        projection = projection_kwargs(fields)
+        query_kwargs['ProjectionExpression'] = projection['ProjectionExpression']
+        query_kwargs['ExpressionAttributeNames'].update(
+            projection['ExpressionAttributeNames'])
+    if cursor:
+        query_kwargs['ExclusiveStartKey'] = {
+            'athleteId': srg_athlete_id, 'activityId': cursor}
+    if page_size:
+        query_kwargs['Limit'] = page_size
+    while True:
+        response = activities_table.query(**query_kwargs)
+        last_evaluated_key = response.get('LastEvaluatedKey')
+        yield response['Items'], last_evaluated_key
+        if not last_evaluated_key:
+            return
+        query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def fetch_all_activities_req(srg_athlete_id, fields=None):
+    activities = []
+    for items, _ in iter_activity_pages_req(srg_athlete_id, fields=fields):
+        activities.extend(items)
+    return activities
+
+
+def fetch_activities_page_req(srg_athlete_id, limit, cursor=None, fields=None):
+    activities = []
+    next_cursor = None
+    pages = iter_activity_pages_req(srg_athlete_id, cursor, limit, fields)
+    for items, last_evaluated_key in pages:
+        activities.extend(items)
+        if len(activities) >= limit:
+            truncated = len(activities) > limit
+            activities = activities[:limit]
+            if last_evaluated_key or truncated:
+                next_cursor = activities[-1]['activityId']
+            break
+    pages.close()
+    return activities, next_cursor
+
+
+def stream_json_array(pages):
+    yield '['
+    first = True
+    for items in pages:
+        if not items:
+            continue
+        # One encoder call per page, minus the page's own brackets
+        chunk = current_app.json.dumps(
+            [decode_item_blobs(item) for item in items])[1:-1]
+        yield chunk if first else ',' + chunk
+        first = False
+    yield ']'
 
 
 def fetch_all_activities():
     srg_athlete_id = request.args.get('srg_athlete_id')
-    r = fetch_all_activities_req(srg_athlete_id)
-    return r
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    fields = parse_fields(request.args.get('fields'))
+    if limit:
+        activities, next_cursor = fetch_activities_page_req(
+            srg_athlete_id, limit, cursor, fields)
+        response = jsonify([decode_item_blobs(item) for item in activities])
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    pages = (items for items, _ in iter_activity_pages_req(
+        srg_athlete_id, cursor, fields=fields))
+    # Read the first page before streaming so DynamoDB errors still get the
+    # route's error handling instead of a truncated body
+    first_page = next(pages)
+    return Response(
+        stream_with_context(stream_json_array(chain([first_page], pages))),
+        mimetype='application/json'
+    )
 
 ###### Get Logged In User ######
 
@@ -369,6 +715,8 @@ def route_get_logged_in_user():
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 429)
         return response
+    except StravaUnavailableError:
+        raise
     except Exception as e:
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 500)
@@ -383,17 +731,14 @@ def get_logged_in_user():
 
 
 def get_logged_in_user_req(access_token):
-    url = "https://www.strava.com/api/v3/athlete"
-    r = requests.get(
-        url + '?access_token=' + access_token,
+    url = f"{STRAVA_API_URL}/athlete"
+    r = get_strava_client().get(
+        url,
+        access_token=access_token,
         params={'scope': 'profile:read_all'}
     )
     r_json = r.json()
     if 'errors' in r_json and any(error.get('code') == 'exceeded' for error in r_json['errors']):
-        print('X-RateLimit-Limit')
-        pprint(r.headers.get('X-RateLimit-Limit'))
-        print('X-RateLimit-Usage')
-        pprint(r.headers.get('X-RateLimit-Usage'))
         raise RateLimitError('Rate Limit Exceeded')
     return r_json
 
@@ -408,6 +753,8 @@ def route_get_athlete_stats(athleteId):
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 429)
         return response
+    except StravaUnavailableError:
+        raise
     except Exception as e:
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 500)
@@ -421,8 +768,8 @@ def fetch_athlete_stats(athleteId):
 
 
 def fetch_athlete_stats_req(athleteId, access_token):
-    url = 'https://www.strava.com/api/v3/athletes/' + athleteId + '/stats/'
-    r = requests.get(url + '?access_token=' + access_token)
+    url = f"{STRAVA_API_URL}/athletes/{athleteId}/stats/"
+    r = get_strava_client().get(url, access_token=access_token)
     r = r.json()
     return r
 
@@ -437,6 +784,8 @@ def route_add_all_activities():
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 429)
         return response
+    except StravaUnavailableError:
+        raise
     except Exception as e:
         error_message = str(e)
         response = make_response(jsonify({'error': error_message}), 500)
@@ -445,13 +794,91 @@ def route_add_all_activities():
 
 def add_all_activities():
     srg_athlete_id = request.args.get('srg_athlete_id')
+    full_resync = request.args.get('full_resync', 'false').lower() == 'true'
     access_token = get_access_token_from_athlete_id(srg_athlete_id)
-    activities_to_return = add_all_activities_req(access_token)
-    return activities_to_return
 
+    def sync_job(job):
+        add_all_activities_req(access_token, srg_athlete_id, full_resync, job)
+    # One sync per athlete, asking again returns the one already running
+    job = get_job_registry().submit(
+        'addAllActivities', srg_athlete_id, sync_job, exclusive=True)
+    return make_response(jsonify({'status': 'accepted', 'message': 'Activity Sync Started', 'jobId': job.id}), 202)
+
+
+@data_controller_bp.route('/srg/syncStatus', methods=["GET"])
+def route_get_sync_status():
+    srg_athlete_id = request.args.get('srg_athlete_id')
+    job = get_job_registry().latest('addAllActivities', srg_athlete_id)
+    if job is None:
+        return make_response(jsonify({'error': 'Job Not Found'}), 404)
+    return job.to_dict()
+
+
+def start_date_to_epoch(start_date):
+    return calendar.timegm(time.strptime(start_date, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def get_sync_watermark_req(srg_athlete_id):
+    tokens_table = get_table('srg-token-table')
+    response = tokens_table.get_item(
+        Key={
+            'athleteId': srg_athlete_id
+        },
+        ProjectionExpression='syncWatermark'
+    )
+    watermark = response.get('Item', {}).get('syncWatermark')
+    return int(watermark) if watermark is not None else None
+
+
+def save_sync_watermark_req(srg_athlete_id, watermark):
+    # Also drops the checkpoint, the sync it belonged to is complete
+    tokens_table = get_table('srg-token-table')
+    tokens_table.update_item(
+        Key={'athleteId': srg_athlete_id},
+        UpdateExpression='SET #syncWatermarkAttr = :syncWatermarkValue REMOVE #syncCheckpointAttr',
+        ExpressionAttributeNames={
+            '#syncWatermarkAttr': 'syncWatermark',
+            '#syncCheckpointAttr': 'syncCheckpoint'
+        },
+        ExpressionAttributeValues={':syncWatermarkValue': watermark}
+    )
+    return 'ok'
+
+
+def get_sync_checkpoint_req(srg_athlete_id):
+    tokens_table = get_table('srg-token-table')
+    response = tokens_table.get_item(
+        Key={
+            'athleteId': srg_athlete_id
+        },
+        ProjectionExpression='syncCheckpoint'
+    )
+    return response.get('Item', {}).get('syncCheckpoint')
+
+
+def clear_sync_checkpoint_req(srg_athlete_id):
+    tokens_table = get_table('srg-token-table')
+    tokens_table.update_item(
+        Key={'athleteId': srg_athlete_id},
+        UpdateExpression='REMOVE #syncCheckpointAttr',
+        ExpressionAttributeNames={'#syncCheckpointAttr': 'syncCheckpoint'}
+    )
+    return 'ok'
 
-def update_or_insert_item(entry, activities_table):
-    item = {
+
+def save_sync_checkpoint_req(srg_athlete_id, checkpoint):
+    tokens_table = get_table('srg-token-table')
+    tokens_table.update_item(
+        Key={'athleteId': srg_athlete_id},
+        UpdateExpression='SET #syncCheckpointAttr = :syncCheckpointValue',
+        ExpressionAttributeNames={'#syncCheckpointAttr': 'syncCheckpoint'},
+        ExpressionAttributeValues={':syncCheckpointValue': checkpoint}
+    )
+    return 'ok'
+
+
+def activity_to_item(entry):
+    return {
         'athleteId': str(entry['athlete']['id']),
         'activityId': str(entry['id']),
         'name': entry['name'],
@@ -476,51 +903,144 @@ def update_or_insert_item(entry, activities_table):
         'pr_count': entry['pr_count']
     }
 
-    try:
-        activities_table.put_item(
-            Item=item,
-            ConditionExpression='attribute_not_exists(athleteId) AND attribute_not_exists(activityId)'
-        )
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            activities_table.update_item(
-                Key={
-                    'athleteId': str(item['athleteId']),
-                    'activityId': str(item['activityId']),
-                },
-                UpdateExpression='SET ' +
-                ', '.join([f"#{key} = :{key}" for key in item.keys()
-                          if key not in ['athleteId', 'activityId']]),
-                ExpressionAttributeNames={
-                    f"#{key}": key for key in item.keys() if key not in ['athleteId', 'activityId']
-                },
-                ExpressionAttributeValues={
-                    f":{key}": value for key, value in item.items() if key not in ['athleteId', 'activityId']
-                }
-            )
-        else:
-            print(f"Error during put_item: {e}")
-
-
-def add_all_activities_req(access_token):
-    activities_to_add = fetch_all_activities_strava_req(access_token, 1)
-    # Sort and Filter Activities
-    activities_to_add = sorted(activities_to_add, key=lambda x: (
-        x['distance'] / x['moving_time']) if x['moving_time'] != 0 else float('-inf'), reverse=True)
-
-    activities_to_add = list(filter(lambda x: x['type'] in [
-                             "Walk", "Swim", "Run", "Ride"], activities_to_add))
-
-    dynamodb = boto3.resource('dynamodb')
-    activities_table = dynamodb.Table('srg-activities-table')
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        def update_function(entry): return update_or_insert_item(
-            entry, activities_table)
-        executor.map(update_function, activities_to_add)
+def backoff_sleep(attempt):
+    # Full jitter exponential backoff, capped at a few seconds
+    time.sleep(random.uniform(0, min(5, 0.05 * 2 ** attempt)))
+
+
+def batch_get_items(table_name, keys):
+    dynamodb = get_resource()
+    items = []
+    for i in range(0, len(keys), BATCH_GET_SIZE):
+        request_items = {table_name: {'Keys': keys[i:i + BATCH_GET_SIZE]}}
+        attempt = 0
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            request_items = response.get('UnprocessedKeys')
+            if request_items:
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    raise UnprocessedItemsError(
+                        f"Unprocessed keys in {table_name} after {attempt} retries")
+                get_metrics().retries.inc('dynamodb', 'BatchGetItem')
+                backoff_sleep(attempt)
+                attempt += 1
+    return items
+
+
+def batch_write_requests(table_name, write_requests):
+    dynamodb = get_resource()
+    for i in range(0, len(write_requests), BATCH_WRITE_SIZE):
+        request_items = {table_name: write_requests[i:i + BATCH_WRITE_SIZE]}
+        attempt = 0
+        while request_items:
+            response = dynamodb.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems')
+            if request_items:
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    raise UnprocessedItemsError(
+                        f"Unprocessed items in {table_name} after {attempt} retries")
+                get_metrics().retries.inc('dynamodb', 'BatchWriteItem')
+                backoff_sleep(attempt)
+                attempt += 1
+    return len(write_requests)
+
+
+def ingest_activities(entries):
+    # Diff against what is stored and only write activities that changed.
+    # Stored attributes the summary doesn't carry (cached detail, shoes,
+    # descriptions) are merged in because BatchWriteItem can only put whole items
+    items = {item['activityId']: item for item in map(activity_to_item, entries)}
+    if not items:
+        return 0
+    keys = [{'athleteId': item['athleteId'], 'activityId': item['activityId']}
+            for item in items.values()]
+    stored = {item['activityId']: item
+              for item in batch_get_items('srg-activities-table', keys)}
+
+    write_requests = []
+    for activity_id, item in items.items():
+        existing = stored.get(activity_id)
+        if existing is not None:
+            if all(existing.get(key) == value for key, value in item.items()):
+                continue
+            item = {**existing, **item}
+        write_requests.append({'PutRequest': {'Item': item}})
+    written = batch_write_requests('srg-activities-table', write_requests)
+    for athlete_id in {write['PutRequest']['Item']['athleteId'] for write in write_requests}:
+        bump_data_version(athlete_id)
+    return written
+
+
+def add_all_activities_req(access_token, srg_athlete_id=None, full_resync=False, job=None):
+    watermark = None
+    checkpoint = None
+    if srg_athlete_id is not None:
+        # An interrupted sync (e.g. a Spot reclaim) carries on from the last
+        # page it fully wrote rather than starting over
+        checkpoint = get_sync_checkpoint_req(srg_athlete_id)
+    if checkpoint is not None:
+        after = int(checkpoint['after']) if checkpoint.get(
+            'after') is not None else None
+        watermark = int(checkpoint['watermark']) if checkpoint.get(
+            'watermark') is not None else None
+        start_page = int(checkpoint['page'])
+        if job is not None:
+            job.update(resumedFromPage=start_page)
+    else:
+        if srg_athlete_id is not None and not full_resync:
+            watermark = get_sync_watermark_req(srg_athlete_id)
+        # Strava's after is exclusive, step back a second so an activity sharing
+        # the watermark's start time is upserted again rather than skipped
+        after = watermark - 1 if watermark is not None else None
+        start_page = 1
+
+    synced = 0
+    new_watermark = watermark
+    ingests = deque()
+
+    def complete_ingests(wait):
+        # Checkpoint only past pages whose writes, and all before them, landed
+        while ingests and (wait or ingests[0][1].done()):
+            page, ingest = ingests.popleft()
+            written = ingest.result()
+            if job is not None:
+                job.increment(itemsWritten=written)
+            if srg_athlete_id is not None:
+                save_sync_checkpoint_req(srg_athlete_id, {
+                    'page': page + 1,
+                    'after': after,
+                    'watermark': new_watermark
+                })
+
+    # Bulk syncs yield the rate limit budget to interactive endpoints.
+    # Each page is written while the following pages are still in flight
+    pages = iter_activity_pages_strava(access_token, start_page, BULK, after)
+    for page, r in enumerate(pages, start_page):
+        # Remember the newest start_date seen, across all types, before filtering
+        for x in r:
+            start = start_date_to_epoch(x['start_date'])
+            if new_watermark is None or start > new_watermark:
+                new_watermark = start
+        if job is not None:
+            job.increment(pagesFetched=1, activitiesFetched=len(r))
+        r = list(filter(lambda x: x['type'] in [
+            "Walk", "Swim", "Run", "Ride"], r))
+        ingests.append(
+            (page, dynamodb_executor.submit(ingest_activities, r)))
+        synced += len(r)
+        complete_ingests(wait=False)
+    complete_ingests(wait=True)
+
+    if srg_athlete_id is not None:
+        if new_watermark is not None:
+            save_sync_watermark_req(srg_athlete_id, new_watermark)
+        else:
+            clear_sync_checkpoint_req(srg_athlete_id)
 
     print("Update or insert items completed successfully.")
-    return activities_to_add
+    return synced
 
 ###### Destroy User ######
 
@@ -535,53 +1055,55 @@ def route_destroy_user():
 
 def destroy_user():
     srg_athlete_id = request.args.get('srg_athlete_id')
-    destroy_user_req(srg_athlete_id)
-    destroy_user_tokens_req(srg_athlete_id)
-    return jsonify({'status': 'success', 'message': 'User Deleted'})
+
+    def destroy_user_job(job):
+        destroy_user_req(srg_athlete_id, job)
+        destroy_user_req(srg_athlete_id, job, 'srg-activity-streams-table')
+        destroy_user_tokens_req(srg_athlete_id)
+    # Large accounts take minutes to delete, don't hold a request thread
+    job = get_job_registry().submit('destroyUser', srg_athlete_id, destroy_user_job)
+    return make_response(jsonify({'status': 'accepted', 'message': 'User Deletion Started', 'jobId': job.id}), 202)
 
 
 def destroy_user_tokens_req(srg_athlete_id):
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-token-table'
-    table = dynamodb.Table(table_name)
+    table = get_table('srg-token-table')
     table.delete_item(
         Key={
             'athleteId': srg_athlete_id
         }
     )
+    get_token_cache().invalidate(srg_athlete_id)
     return 'deleted tokens'
 
 
-def destroy_user_req(srg_athlete_id):
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
-
-    # Use query to find all items with the specified athleteId
-    response = table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key(
-            'athleteId').eq(srg_athlete_id)
-    )
-
-    # Delete each item in parallel
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        executor.map(delete_item, [
-                     (item['athleteId'], item['activityId']) for item in response.get('Items', [])])
-
-    return 'deleted activities'
-
-
-def delete_item(keys):
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
-
-    table.delete_item(
-        Key={
-            'athleteId': keys[0],
-            'activityId': keys[1]
-        }
-    )
+def destroy_user_req(srg_athlete_id, job=None, table_name='srg-activities-table'):
+    # Page through the whole partition reading keys only and delete each
+    # page in BatchWriteItem chunks, a few chunks at a time
+    deleted = 0
+    for items, _ in iter_activity_pages_req(srg_athlete_id, fields=['activityId'], table_name=table_name):
+        delete_requests = [{'DeleteRequest': {'Key': {
+            'athleteId': item['athleteId'],
+            'activityId': item['activityId']
+        }}} for item in items]
+        if job is not None:
+            job.increment(found=len(delete_requests))
+        chunks = [delete_requests[i:i + BATCH_WRITE_SIZE]
+                  for i in range(0, len(delete_requests), BATCH_WRITE_SIZE)]
+        for count in dynamodb_executor.map(lambda chunk: batch_write_requests(table_name, chunk), chunks):
+            deleted += count
+            if job is not None:
+                job.increment(deleted=count)
+    if deleted:
+        bump_data_version(srg_athlete_id)
+    return deleted
+
+
+@data_controller_bp.route('/srg/jobStatus/<job_id>', methods=["GET"])
+def route_get_job_status(job_id):
+    job = get_job_registry().get(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'Job Not Found'}), 404)
+    return job.to_dict()
 
 
 @data_controller_bp.route("/srg/shoeAlert", methods=['PUT'])
@@ -596,10 +1118,8 @@ def route_put_shoe_activity_update():
 
 def put_shoe_activity_update_req(access_token, entry_id, shoe_id):
     encoded_shoe_id = quote(shoe_id)
-    url = f"https://www.strava.com/api/v3/activities/{entry_id}?gear_id={encoded_shoe_id}"
-    r = requests.put(
-        url, headers={"Authorization": f"Bearer { access_token }"}
-    )
+    url = f"{STRAVA_API_URL}/activities/{entry_id}?gear_id={encoded_shoe_id}"
+    r = get_strava_client().put(url, access_token=access_token)
     r = r.json()
     if 'errors' in r and any(error.get('code') == 'exceeded' for error in r['errors']):
         raise RateLimitError('Rate Limit Exceeded')
@@ -607,9 +1127,7 @@ def put_shoe_activity_update_req(access_token, entry_id, shoe_id):
 
 
 def update_shoe_one_activity_req(athleteId, activityId, shoe_id, shoe_name):
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
+    table = get_table('srg-activities-table')
     key = {'athleteId': athleteId, 'activityId': activityId}
     update_expression = 'SET #shoeIdAttr = :shoeIdValue, #gearNameAttr = :gearNameValue'
     expression_attribute_names = {
@@ -625,6 +1143,7 @@ def update_shoe_one_activity_req(athleteId, activityId, shoe_id, shoe_name):
         UpdateExpression=update_expression,
         ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
     )
+    bump_data_version(athleteId)
     return 'ok'
 
 
@@ -667,9 +1186,7 @@ def put_activity_update():
 
 
 def update_one_activity_req(athleteId, activityId, name, description):
-    dynamodb = boto3.resource('dynamodb')
-    table_name = 'srg-activities-table'
-    table = dynamodb.Table(table_name)
+    table = get_table('srg-activities-table')
     key = {'athleteId': athleteId, 'activityId': activityId}
     update_expression = 'SET #nameAttr = :nameValue, #descriptionAttr = :descriptionValue'
     expression_attribute_names = {
@@ -685,15 +1202,14 @@ def update_one_activity_req(athleteId, activityId, name, description):
         UpdateExpression=update_expression,
         ExpressionAttributeNames=expression_attribute_names, ExpressionAttributeValues=expression_attribute_values
     )
+    bump_data_version(athleteId)
     return 'ok'
 
 
 def put_activity_update_req(access_token, entry_id, name, description):
     encoded_name = quote(name)
     encoded_description = quote(description)
-    url = f"https://www.strava.com/api/v3/activities/{entry_id}?name={encoded_name}&description={encoded_description}"
-    r = requests.put(
-        url, headers={"Authorization": f"Bearer { access_token }"}
-    )
+    url = f"{STRAVA_API_URL}/activities/{entry_id}?name={encoded_name}&description={encoded_description}"
+    r = get_strava_client().put(url, access_token=access_token)
     r = r.json()
     return r
@@ -0,0 +1,60 @@
+import hashlib
+import uuid
+from pprint import pprint
+from botocore.exceptions import ClientError
+from flask import make_response, request
+from dynamo_utilities import get_table
+from response_pipeline import etag_variants
+
+# Every write to an athlete's data stamps a fresh random version on their
+# token row, cached reads are validated against it with one small GetItem
+
+
+def get_data_version(athlete_id):
+    if not athlete_id:
+        return None
+    try:
+        item = get_table('srg-token-table').get_item(
+            Key={'athleteId': athlete_id}, ProjectionExpression='dataVersion').get('Item', {})
+    except ClientError as e:
+        pprint(e)
+        return None
+    return item.get('dataVersion')
+
+
+def bump_data_version(athlete_id):
+    # Never creates a token row, athletes without one just get no ETags
+    try:
+        get_table('srg-token-table').update_item(
+            Key={'athleteId': athlete_id},
+            UpdateExpression='SET dataVersion = :version',
+            ConditionExpression='attribute_exists(athleteId)',
+            ExpressionAttributeValues={':version': uuid.uuid4().hex}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            pprint(e)
+
+
+def data_etag(version):
+    # The same data renders differently per path and query (fields, cursor...)
+    validator = f"{version}:{request.full_path}".encode('utf-8')
+    return hashlib.sha1(validator).hexdigest()
+
+
+def conditional_response(athlete_id, build):
+    version = get_data_version(athlete_id)
+    if version is None:
+        return build()
+    etag = data_etag(version)
+    # The client may hold a compressed variant, answer with the tag it sent
+    matched = next((tag for tag in etag_variants(etag)
+                   if tag in request.if_none_match), None)
+    if matched is not None:
+        response = make_response('', 304)
+        response.set_etag(matched)
+    else:
+        response = make_response(build())
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,45 @@
+def lttb_indices(points, target):
+    # Largest-Triangle-Three-Buckets over (x, y) points, returns the indices
+    # to keep so every stream of the activity can be sampled the same way
+    size = len(points)
+    if target >= size or target < 3:
+        return list(range(size))
+    indices = [0]
+    bucket_size = (size - 2) / (target - 2)
+    previous = 0
+    for bucket in range(target - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, size)
+        next_points = points[next_start:next_end] or [points[-1]]
+        average_x = sum(point[0] for point in next_points) / len(next_points)
+        average_y = sum(point[1] for point in next_points) / len(next_points)
+        previous_x, previous_y = points[previous]
+
+        best_area = -1
+        best_index = start
+        for index in range(start, end):
+            x, y = points[index]
+            area = abs((previous_x - average_x) * (y - previous_y) -
+                       (previous_x - x) * (average_y - previous_y))
+            if area > best_area:
+                best_area = area
+                best_index = index
+        indices.append(best_index)
+        previous = best_index
+    indices.append(size - 1)
+    return indices
+
+
+def downsample_streams(streams, target):
+    # Shape the selection on the route when there is one, otherwise on the
+    # first series plotted against its position
+    if 'latlng' in streams:
+        points = [tuple(pair) for pair in streams['latlng']['data']]
+    else:
+        first = next(iter(streams.values()))['data']
+        points = [(index, float(value)) for index, value in enumerate(first)]
+    indices = lttb_indices(points, target)
+    return {key: {**stream, 'data': [stream['data'][index] for index in indices if index < len(stream['data'])], 'resolution': 'downsampled'}
+            for key, stream in streams.items()}
@@ -0,0 +1,50 @@
+import threading
+import boto3
+from botocore.config import Config
+from metrics import instrument_dynamodb
+
+# boto3 resources aren't thread-safe, so every thread lazily builds its own
+# resource and tables once and keeps them for its lifetime. They all come from
+# one session, which loads the service model once instead of per thread
+_local = threading.local()
+_session = None
+_session_lock = threading.Lock()
+
+
+def dynamodb_config():
+    # Each thread's client only ever has one call in flight, botocore's
+    # default pool is already more than it needs
+    return Config(retries={'max_attempts': 3, 'mode': 'standard'})
+
+
+def get_resource():
+    global _session
+    resource = getattr(_local, 'resource', None)
+    if resource is None:
+        # Sessions aren't thread-safe either, only build from it under the lock
+        with _session_lock:
+            if _session is None:
+                _session = boto3.session.Session()
+            resource = _session.resource('dynamodb', config=dynamodb_config())
+        instrument_dynamodb(resource.meta.client)
+        _local.resource = resource
+        _local.tables = {}
+    return resource
+
+
+def get_table(table_name):
+    resource = get_resource()
+    table = _local.tables.get(table_name)
+    if table is None:
+        table = _local.tables[table_name] = resource.Table(table_name)
+    return table
+
+
+def reset_tables():
+    # Drops the session and this thread's cached resource, e.g. after
+    # credentials change
+    global _session
+    with _session_lock:
+        _session = None
+    _local.resource = None
+    _local.tables = {}
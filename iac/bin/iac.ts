@@ -14,6 +14,8 @@ const {
   STRAVA_CLIENT_ID,
   STRAVA_CLIENT_SECRET,
   STRAVA_EXC_TOKEN_REDIRECT_URI,
+  STRAVA_WEBHOOK_VERIFY_TOKEN,
+  STRAVA_WEBHOOK_SUBSCRIPTION_ID,
 } = process.env;
 
 if (!AWS_ACCOUNT_NUMBER) {
@@ -51,6 +53,12 @@ if (!STRAVA_EXC_TOKEN_REDIRECT_URI) {
   );
 }
 
+if (!STRAVA_WEBHOOK_VERIFY_TOKEN) {
+  throw new Error(
+    'STRAVA_WEBHOOK_VERIFY_TOKEN environment variable is undefined!'
+  );
+}
+
 new SRGPythonStack(app, 'SRGPythonStack', {
   aws_env: {
     AWS_CLUSTER_ARN,
@@ -61,6 +69,10 @@ new SRGPythonStack(app, 'SRGPythonStack', {
     STRAVA_CLIENT_ID,
     STRAVA_CLIENT_SECRET,
     STRAVA_EXC_TOKEN_REDIRECT_URI,
+    STRAVA_WEBHOOK_VERIFY_TOKEN,
+    // Only known once the subscription exists, until then every webhook
+    // event is rejected
+    STRAVA_WEBHOOK_SUBSCRIPTION_ID,
   },
   env: {
     account: AWS_ACCOUNT_NUMBER,
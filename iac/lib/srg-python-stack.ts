@@ -19,6 +19,8 @@ interface SRGPythonStackProps extends cdk.StackProps {
     STRAVA_CLIENT_ID: string;
     STRAVA_CLIENT_SECRET: string;
     STRAVA_EXC_TOKEN_REDIRECT_URI: string;
+    STRAVA_WEBHOOK_VERIFY_TOKEN: string;
+    STRAVA_WEBHOOK_SUBSCRIPTION_ID?: string;
   };
 }
 
@@ -80,6 +82,10 @@ export class SRGPythonStack extends cdk.Stack {
           strava_client_secret: props.svc_env.STRAVA_CLIENT_SECRET,
           strava_exc_token_redirect_uri:
             props.svc_env.STRAVA_EXC_TOKEN_REDIRECT_URI,
+          strava_webhook_verify_token:
+            props.svc_env.STRAVA_WEBHOOK_VERIFY_TOKEN,
+          strava_webhook_subscription_id:
+            props.svc_env.STRAVA_WEBHOOK_SUBSCRIPTION_ID ?? '',
           FLASK_ENVIRONMENT: 'production',
         },
         image: ecs.ContainerImage.fromAsset('../'),
@@ -148,5 +154,12 @@ export class SRGPythonStack extends cdk.Stack {
       sortKey: { name: 'activityId', type: dynamodb.AttributeType.STRING },
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
     });
+
+    new dynamodb.Table(this, 'srg-activity-streams', {
+      tableName: 'srg-activity-streams-table',
+      partitionKey: { name: 'athleteId', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'activityId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+    });
   }
 }
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pprint import pprint
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class Job:
+    def __init__(self, kind, athlete_id):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.athlete_id = athlete_id
+        self.status = QUEUED
+        self.progress = {}
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.lock = threading.Lock()
+
+    def update(self, **progress):
+        with self.lock:
+            self.progress.update(progress)
+            self.updated_at = time.time()
+
+    def increment(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.progress[key] = self.progress.get(key, 0) + value
+            self.updated_at = time.time()
+
+    def set_status(self, status, error=None):
+        with self.lock:
+            self.status = status
+            self.error = error
+            self.updated_at = time.time()
+
+    @property
+    def finished(self):
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'jobId': self.id,
+                'kind': self.kind,
+                'athleteId': self.athlete_id,
+                'status': self.status,
+                'progress': dict(self.progress),
+                'error': self.error,
+                'createdAt': int(self.created_at),
+                'updatedAt': int(self.updated_at)
+            }
+
+
+class JobRegistry:
+    def __init__(self, max_workers, max_jobs):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='srg-job')
+        # Oldest jobs are forgotten first once max_jobs is reached
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+            max_jobs=int(os.environ.get('JOB_HISTORY', 1000))
+        )
+
+    def _run(self, job, fn):
+        job.set_status(RUNNING)
+        try:
+            fn(job)
+            job.set_status(SUCCEEDED)
+        except Exception as e:
+            pprint(e)
+            job.set_status(FAILED, str(e))
+
+    def submit(self, kind, athlete_id, fn, exclusive=False):
+        # With exclusive, an unfinished job of the same kind for the athlete
+        # is returned instead of starting another one
+        with self.lock:
+            if exclusive:
+                active = self._latest(kind, athlete_id)
+                if active is not None and not active.finished:
+                    return active
+            job = Job(kind, athlete_id)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.executor.submit(self._run, job, fn)
+        return job
+
+    def _latest(self, kind, athlete_id):
+        for job in reversed(self.jobs.values()):
+            if job.kind == kind and job.athlete_id == athlete_id:
+                return job
+        return None
+
+    def latest(self, kind, athlete_id):
+        with self.lock:
+            return self._latest(kind, athlete_id)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+_job_registry = None
+_job_registry_lock = threading.Lock()
+
+
+def get_job_registry():
+    global _job_registry
+    if _job_registry is None:
+        with _job_registry_lock:
+            if _job_registry is None:
+                _job_registry = JobRegistry.from_env()
+    return _job_registry
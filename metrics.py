@@ -0,0 +1,231 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlparse
+from flask import g, has_request_context, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+    def lines(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def count(self, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            return sum(counts[0]) if counts else 0
+
+    def lines(self):
+        with self.lock:
+            values = {labels: (list(counts), total)
+                      for labels, (counts, total) in self.values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, [('le', format_value(bound))])} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        # collect() returns {label values tuple: value}, read at scrape time
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def lines(self):
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+def strava_operation(method, url):
+    # Ids would make every activity its own series
+    path = urlparse(url).path.replace('/api/v3', '', 1)
+    return f"{method.upper()} {re.sub(r'/[0-9]+', '/:id', path.rstrip('/'))}"
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = []
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.request_duration = self.histogram(
+            'srg_request_duration_seconds', 'Time to produce a response, by route', ('method', 'route', 'status'))
+        self.dependency_duration = self.histogram(
+            'srg_dependency_duration_seconds', 'Time spent in calls to Strava and DynamoDB', ('dependency', 'operation'))
+        self.rate_limited = self.counter(
+            'srg_rate_limit_errors_total', 'Strava calls refused by our budget or answered with a 429', ('reason',))
+        self.retries = self.counter(
+            'srg_retries_total', 'Retried dependency calls', ('dependency', 'operation'))
+        self.gauge('srg_requests_in_flight', 'Requests being handled right now',
+                   (), lambda: {(): self.in_flight})
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=()):
+        metric = Histogram(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labelnames, collect):
+        metric = Gauge(name, documentation, labelnames, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+    def record_dependency(self, dependency, operation, seconds):
+        self.dependency_duration.observe(seconds, dependency, operation)
+        # Calls made on the request's own thread also go in Server-Timing
+        if has_request_context():
+            timing = g.get('dependency_timing')
+            if timing is not None:
+                timing[dependency] = timing.get(dependency, 0.0) + seconds
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.end_request)
+
+    def start_request(self):
+        g.request_started = time.perf_counter()
+        g.dependency_timing = {}
+        with self.lock:
+            self.in_flight += 1
+
+    def finish_request(self, response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.request_duration.observe(
+            elapsed, request.method, route, str(response.status_code))
+        timing = [f"{name};dur={seconds * 1000:.1f}"
+                  for name, seconds in g.get('dependency_timing', {}).items()]
+        encode = g.get('response_timing', {}).get('encode')
+        if encode:
+            timing.append(f"encode;dur={encode * 1000:.1f}")
+        timing.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers['Server-Timing'] = ', '.join(timing)
+        return response
+
+    def end_request(self, exc=None):
+        if g.pop('request_started', None) is not None:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def start_dynamodb_call(context, **kwargs):
+    context['srg_started'] = time.perf_counter()
+
+
+def finish_dynamodb_call(event_name, context, parsed=None, **kwargs):
+    started = context.pop('srg_started', None)
+    if started is None:
+        return
+    # after-call-error carries no model, the event name ends in the operation
+    operation = event_name.rsplit('.', 1)[-1]
+    metrics = get_metrics()
+    metrics.record_dependency(
+        'dynamodb', operation, time.perf_counter() - started)
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        metrics.retries.inc('dynamodb', operation, amount=retries)
+
+
+def instrument_dynamodb(client):
+    # botocore fires these around every operation, including its own retries
+    client.meta.events.register('before-call.dynamodb', start_dynamodb_call)
+    client.meta.events.register('after-call.dynamodb', finish_dynamodb_call)
+    client.meta.events.register(
+        'after-call-error.dynamodb', finish_dynamodb_call)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
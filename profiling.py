@@ -0,0 +1,243 @@
+import cProfile
+import hmac
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from urllib.parse import urlencode
+from flask import g, request
+
+PROFILE_HEADER = 'X-SRG-Profile'
+
+
+class StackSampler:
+    # Wall-clock samples of one thread's stack, folded into the
+    # "root;caller;callee count" lines flamegraph.pl and speedscope read
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name='srg-profile-sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profile:
+    def __init__(self, method, path, sample_interval):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.seconds = None
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), sample_interval)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        self.profiler.enable()
+
+    def pause(self):
+        self.profiler.disable()
+
+    def resume(self):
+        self.profiler.enable()
+
+    def finish(self):
+        self.profiler.disable()
+        self.sampler.stop()
+        self.seconds = time.perf_counter() - self.started
+
+    def top(self, limit):
+        stats = pstats.Stats(self.profiler).stats
+        rows = sorted(stats.items(), key=lambda row: row[1][3], reverse=True)
+        return [{
+            'function': f"{name} ({os.path.basename(filename)}:{line})",
+            'calls': calls,
+            'totalSeconds': total,
+            'cumulativeSeconds': cumulative
+        } for (filename, line, name), (_, calls, total, cumulative, _) in rows[:limit]]
+
+    def summary(self, limit):
+        return {
+            'profileId': self.id,
+            'method': self.method,
+            'path': self.path,
+            'startedAt': int(self.started_at),
+            'seconds': self.seconds,
+            'samples': sum(self.sampler.stacks.values()),
+            'top': self.top(limit)
+        }
+
+
+class RequestProfiler:
+    def __init__(self, token, min_interval, max_seconds, sample_interval, top, history, directory):
+        # Without a token nobody can turn profiling on
+        self.token = token
+        self.min_interval = min_interval
+        self.max_seconds = max_seconds
+        self.sample_interval = sample_interval
+        self.top = top
+        self.history = history
+        self.directory = directory
+        self.profiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.running = False
+        self.last_started = 0.0
+        self.skipped = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token=os.environ.get('PROFILE_TOKEN'),
+            min_interval=float(os.environ.get('PROFILE_MIN_INTERVAL', 60)),
+            max_seconds=float(os.environ.get('PROFILE_MAX_SECONDS', 300)),
+            sample_interval=float(os.environ.get(
+                'PROFILE_SAMPLE_INTERVAL', 0.005)),
+            top=int(os.environ.get('PROFILE_TOP', 30)),
+            history=int(os.environ.get('PROFILE_HISTORY', 20)),
+            directory=os.environ.get('PROFILE_DIR')
+        )
+
+    def init_app(self, app):
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    def authorized(self, value):
+        return bool(self.token) and value is not None and hmac.compare_digest(value, self.token)
+
+    def requested(self):
+        return self.authorized(request.headers.get(PROFILE_HEADER) or request.args.get('srg_profile'))
+
+    def _claim(self):
+        # One profile at a time and at most one per min_interval, so leaving
+        # the token configured can't slow the service down
+        with self.lock:
+            now = time.time()
+            # A streamed body that was never read never finishes its profile
+            running = self.running and now - self.last_started < self.max_seconds
+            if running or now - self.last_started < self.min_interval:
+                self.skipped += 1
+                return False
+            self.running = True
+            self.last_started = now
+            return True
+
+    def start_request(self):
+        if not self.requested():
+            return
+        if not self._claim():
+            g.profile_skipped = True
+            return
+        # Stored without the token
+        query = urlencode([(key, value) for key, value in request.args.items(
+            multi=True) if key != 'srg_profile'])
+        profile = Profile(request.method, f"{request.path}?{query}" if query else request.path,
+                          self.sample_interval)
+        try:
+            profile.start()
+        except ValueError:
+            # Another profiler already owns the interpreter
+            profile.sampler.stop()
+            with self.lock:
+                self.running = False
+            return
+        g.profile = profile
+
+    def finish_request(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            if g.pop('profile_skipped', False):
+                response.headers[PROFILE_HEADER] = 'skipped'
+            return response
+        response.headers[PROFILE_HEADER] = profile.id
+        if response.is_streamed:
+            # Keep profiling while the body is generated, not in between
+            profile.pause()
+            response.response = self.profile_stream(
+                profile, response.response)
+        else:
+            self.save(profile)
+        return response
+
+    def profile_stream(self, profile, chunks):
+        iterator = iter(chunks)
+        try:
+            while True:
+                profile.resume()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    profile.pause()
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.save(profile)
+
+    def save(self, profile):
+        profile.finish()
+        with self.lock:
+            self.running = False
+            self.profiles[profile.id] = profile
+            while len(self.profiles) > self.history:
+                self.profiles.popitem(last=False)
+        if self.directory:
+            with open(os.path.join(self.directory, f"{profile.id}.collapsed"), 'w') as file:
+                file.write(profile.sampler.collapsed())
+            profile.profiler.dump_stats(
+                os.path.join(self.directory, f"{profile.id}.prof"))
+
+    def get(self, profile_id):
+        with self.lock:
+            return self.profiles.get(profile_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': bool(self.token),
+                'running': self.running,
+                'skipped': self.skipped,
+                'profiles': [{'profileId': profile.id, 'path': profile.path, 'seconds': profile.seconds}
+                             for profile in self.profiles.values()]
+            }
+
+
+_request_profiler = None
+_request_profiler_lock = threading.Lock()
+
+
+def get_request_profiler():
+    global _request_profiler
+    if _request_profiler is None:
+        with _request_profiler_lock:
+            if _request_profiler is None:
+                _request_profiler = RequestProfiler.from_env()
+    return _request_profiler
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+SHORT_WINDOW_SECONDS = 15 * 60
+DAILY_WINDOW_SECONDS = 24 * 60 * 60
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class RateLimitWindow:
+    def __init__(self, length, limit):
+        self.length = length
+        self.limit = limit
+        self.usage = 0
+        self.resets_at = self._next_reset(time.time())
+
+    def _next_reset(self, now):
+        # Strava resets the short window on the quarter hour and the daily
+        # window at midnight UTC
+        return (now // self.length + 1) * self.length
+
+    def roll(self, now):
+        if now >= self.resets_at:
+            self.usage = 0
+            self.resets_at = self._next_reset(now)
+
+    def remaining(self, reserve=0):
+        return self.limit - reserve - self.usage
+
+    def to_dict(self):
+        return {
+            'limit': self.limit,
+            'usage': self.usage,
+            'resetsAt': int(self.resets_at)
+        }
+
+
+class StravaRateLimiter:
+    def __init__(self, short_limit, daily_limit, interactive_reserve, max_bulk_wait):
+        self.short_window = RateLimitWindow(SHORT_WINDOW_SECONDS, short_limit)
+        self.daily_window = RateLimitWindow(DAILY_WINDOW_SECONDS, daily_limit)
+        # Fraction of each window that bulk callers may never spend
+        self.interactive_reserve = interactive_reserve
+        self.max_bulk_wait = max_bulk_wait
+        self.bulk_tokens = None
+        self.bulk_refilled_at = time.time()
+        self.deferred = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            short_limit=int(os.environ.get('STRAVA_RATE_LIMIT_SHORT', 200)),
+            daily_limit=int(os.environ.get('STRAVA_RATE_LIMIT_DAILY', 2000)),
+            interactive_reserve=float(os.environ.get(
+                'STRAVA_RATE_LIMIT_INTERACTIVE_RESERVE', 0.2)),
+            max_bulk_wait=float(os.environ.get(
+                'STRAVA_RATE_LIMIT_MAX_BULK_WAIT', SHORT_WINDOW_SECONDS))
+        )
+
+    def _reserve(self, window, priority):
+        if priority == BULK:
+            return int(window.limit * self.interactive_reserve)
+        return 0
+
+    def _refill_bulk_tokens(self, now):
+        # Spread what is left of the bulk budget evenly over the rest of the
+        # short window instead of letting one sync burn it in a burst
+        budget = min(
+            self.short_window.remaining(
+                self._reserve(self.short_window, BULK)),
+            self.daily_window.remaining(
+                self._reserve(self.daily_window, BULK))
+        )
+        seconds_left = max(self.short_window.resets_at - now, 1)
+        rate = max(budget, 0) / seconds_left
+        burst = max(budget / 10, 1)
+        if self.bulk_tokens is None:
+            self.bulk_tokens = burst
+        elapsed = now - self.bulk_refilled_at
+        self.bulk_tokens = min(self.bulk_tokens + elapsed * rate, burst)
+        self.bulk_refilled_at = now
+        return rate
+
+    def _wait_for(self, priority, now):
+        for window in (self.short_window, self.daily_window):
+            if window.remaining(self._reserve(window, priority)) <= 0:
+                return window.resets_at - now
+        if priority == BULK:
+            rate = self._refill_bulk_tokens(now)
+            if self.bulk_tokens < 1:
+                return (1 - self.bulk_tokens) / rate
+        return 0
+
+    def acquire(self, priority=INTERACTIVE):
+        with self.condition:
+            deadline = None
+            while True:
+                now = time.time()
+                self.short_window.roll(now)
+                self.daily_window.roll(now)
+                wait = self._wait_for(priority, now)
+                if wait <= 0:
+                    break
+                # Interactive calls never queue behind the budget, a user
+                # request is better off failing fast with a 429
+                if priority != BULK:
+                    self.rejected += 1
+                    raise RateLimitError('Rate Limit Exceeded')
+                if deadline is None:
+                    deadline = now + self.max_bulk_wait
+                    self.deferred += 1
+                if now + wait > deadline:
+                    self.rejected += 1
+                    raise RateLimitError('Rate Limit Exceeded')
+                self.condition.wait(wait)
+            if priority == BULK and self.bulk_tokens is not None:
+                self.bulk_tokens -= 1
+            self.short_window.usage += 1
+            self.daily_window.usage += 1
+
+    def update(self, response):
+        headers = getattr(response, 'headers', None) or {}
+        limits = parse_rate_limit_header(headers.get('X-RateLimit-Limit'))
+        usage = parse_rate_limit_header(headers.get('X-RateLimit-Usage'))
+        with self.condition:
+            if limits:
+                self.short_window.limit, self.daily_window.limit = limits
+            if usage:
+                self.short_window.usage, self.daily_window.usage = usage
+            if getattr(response, 'status_code', None) == 429:
+                self.short_window.usage = max(
+                    self.short_window.usage, self.short_window.limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'shortWindow': self.short_window.to_dict(),
+                'dailyWindow': self.daily_window.to_dict(),
+                'deferred': self.deferred,
+                'rejected': self.rejected
+            }
+
+
+def parse_rate_limit_header(value):
+    # Strava sends "<15 minute>,<daily>", e.g. "200,2000"
+    if not value:
+        return None
+    try:
+        short, daily = value.split(',')[:2]
+        return int(short), int(daily)
+    except ValueError:
+        return None
@@ -0,0 +1,127 @@
+import numpy as np
+from flask import Blueprint, make_response, request, jsonify
+from data_utilities import fetch_all_activities_req
+
+report_controller_bp = Blueprint('report_controller', __name__)
+
+REPORT_FIELDS = [
+    'name', 'type', 'start_date', 'distance', 'moving_time', 'elapsed_time',
+    'average_speed', 'max_speed', 'total_elevation_gain',
+    'average_heartrate', 'max_heartrate', 'kudos_count', 'comment_count',
+    'pr_count', 'gearName'
+]
+SORT_COLUMNS = {
+    'pace': 'speed',
+    'speed': 'speed',
+    'distance': 'distance',
+    'elevation': 'total_elevation_gain',
+    'date': 'start',
+    'time': 'moving_time'
+}
+PERIOD_UNITS = {'month': 'M', 'year': 'Y'}
+
+
+class ActivityColumns:
+    # One NumPy array per report column, rows line up with self.items
+    def __init__(self, items):
+        self.items = items
+        count = len(items)
+
+        def numeric(key):
+            return np.fromiter((item.get(key) or 0 for item in items), dtype=np.float64, count=count)
+        self.type = np.array([item.get('type', '') for item in items], dtype=object)
+        self.start = np.array([item.get('start_date', '1970-01-01T00:00:00Z').rstrip('Z')
+                               for item in items], dtype='datetime64[s]')
+        self.distance = numeric('distance')
+        self.moving_time = numeric('moving_time')
+        self.total_elevation_gain = numeric('total_elevation_gain')
+        self.speed = np.divide(self.distance, self.moving_time, out=np.full(
+            count, -np.inf), where=self.moving_time != 0)
+
+    def filter_mask(self, sport=None, start=None, end=None):
+        mask = np.ones(len(self.items), dtype=bool)
+        if sport:
+            mask &= self.type == sport
+        if start is not None:
+            mask &= self.start >= start
+        if end is not None:
+            mask &= self.start < end
+        return mask
+
+    def sort_order(self, rows, column, descending=True):
+        values = getattr(self, SORT_COLUMNS[column])[rows]
+        order = np.argsort(values, kind='stable')
+        return rows[order[::-1] if descending else order]
+
+    def period_keys(self, rows, period):
+        days = self.start[rows].astype('datetime64[D]')
+        if period == 'week':
+            # Weeks start on Monday, 1970-01-01 was a Thursday
+            return days - (days.astype(np.int64) + 3) % 7
+        return days.astype(f"datetime64[{PERIOD_UNITS[period]}]")
+
+    def totals(self, rows, period):
+        keys, inverse = np.unique(
+            self.period_keys(rows, period), return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(keys))
+        sums = {column: np.bincount(inverse, weights=getattr(self, column)[rows], minlength=len(keys))
+                for column in ['distance', 'moving_time', 'total_elevation_gain']}
+        return [{
+            'period': str(key),
+            'count': int(counts[i]),
+            'distance': float(sums['distance'][i]),
+            'moving_time': float(sums['moving_time'][i]),
+            'total_elevation_gain': float(sums['total_elevation_gain'][i])
+        } for i, key in enumerate(keys)]
+
+
+@report_controller_bp.route('/srg/report', methods=['GET'])
+def route_get_report():
+    try:
+        return get_report()
+    except ValueError as e:
+        error_message = str(e)
+        response = make_response(jsonify({'error': error_message}), 400)
+        return response
+
+
+def parse_date(value):
+    return np.datetime64(value, 's') if value else None
+
+
+def get_report():
+    srg_athlete_id = request.args.get('srg_athlete_id')
+    sort = request.args.get('sort', 'pace')
+    period = request.args.get('period')
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Invalid sort: {sort}")
+    if period is not None and period not in ['week', *PERIOD_UNITS.keys()]:
+        raise ValueError(f"Invalid period: {period}")
+    return get_report_req(
+        srg_athlete_id,
+        sport=request.args.get('sport'),
+        start=parse_date(request.args.get('start')),
+        end=parse_date(request.args.get('end')),
+        sort=sort,
+        descending=request.args.get('order', 'desc') != 'asc',
+        period=period,
+        page=max(request.args.get('page', 1, type=int), 1),
+        page_size=min(max(request.args.get('page_size', 50, type=int), 1), 500)
+    )
+
+
+def get_report_req(srg_athlete_id, sport=None, start=None, end=None, sort='pace', descending=True, period=None, page=1, page_size=50):
+    columns = ActivityColumns(fetch_all_activities_req(
+        srg_athlete_id, fields=REPORT_FIELDS))
+    rows = np.flatnonzero(columns.filter_mask(sport, start, end))
+    ordered = columns.sort_order(rows, sort, descending)
+    page_rows = ordered[(page - 1) * page_size:page * page_size]
+    report = {
+        'total': int(len(rows)),
+        'page': page,
+        'pageSize': page_size,
+        'activities': [columns.items[row] for row in page_rows]
+    }
+    if period:
+        report['totals'] = columns.totals(rows, period)
+    return report
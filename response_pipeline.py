@@ -0,0 +1,217 @@
+import gzip
+import os
+import threading
+import time
+import zlib
+from decimal import Decimal
+from flask import g, has_request_context, request
+from flask.json.provider import JSONProvider
+import orjson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ['application/json', 'text/plain', 'text/html']
+
+
+def content_encodings():
+    # Server preference when the client accepts both equally
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def etag_variants(etag):
+    # A compressed body is a different representation, so it gets its own
+    # strong validator
+    return [etag, *(f"{etag}-{encoding}" for encoding in ['br', 'gzip'])]
+
+
+def json_default(value):
+    # Matches Flask's default provider, which sends Decimals as strings
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(
+        f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def add_encode_time(seconds):
+    if has_request_context():
+        timing = g.get('response_timing')
+        if timing is not None:
+            timing['encode'] += seconds
+
+
+class FastJSONProvider(JSONProvider):
+    # orjson walks DynamoDB items in C and only calls back for Decimals
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps_bytes(self, obj):
+        started = time.perf_counter()
+        data = orjson.dumps(obj, default=json_default, option=self.option)
+        add_encode_time(time.perf_counter() - started)
+        return data
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype='application/json')
+
+
+class ResponseStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, encoding, bytes_before, bytes_after, encode_seconds, compress_seconds):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'responses': 0,
+                'compressed': 0,
+                'bytesBefore': 0,
+                'bytesAfter': 0,
+                'encodeSeconds': 0.0,
+                'compressSeconds': 0.0
+            })
+            stats['responses'] += 1
+            stats['compressed'] += encoding is not None
+            stats['bytesBefore'] += bytes_before
+            stats['bytesAfter'] += bytes_after
+            stats['encodeSeconds'] += encode_seconds
+            stats['compressSeconds'] += compress_seconds
+
+    def stats(self):
+        with self.lock:
+            return {endpoint: {
+                **stats,
+                'ratio': stats['bytesAfter'] / stats['bytesBefore'] if stats['bytesBefore'] else 1.0
+            } for endpoint, stats in self.endpoints.items()}
+
+
+class ResponseCompressor:
+    def __init__(self, min_size, gzip_level, brotli_quality):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.response_stats = ResponseStats()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            min_size=int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', 1024)),
+            gzip_level=int(os.environ.get('RESPONSE_GZIP_LEVEL', 6)),
+            brotli_quality=int(os.environ.get('RESPONSE_BROTLI_QUALITY', 5))
+        )
+
+    def init_app(self, app):
+        app.json = FastJSONProvider(app)
+        app.before_request(self.start_timing)
+        app.after_request(self.compress_response)
+
+    def start_timing(self):
+        g.response_timing = {'encode': 0.0}
+
+    def negotiate(self):
+        return request.accept_encodings.best_match(content_encodings())
+
+    def compress(self, encoding, data):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def stream_compressor(self, encoding):
+        # Returns (compress, finish), each chunk is flushed so the client
+        # still receives the array page by page
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return (lambda data: compressor.process(data) + compressor.flush()), compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return (lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)), compressor.flush
+
+    def compress_response(self, response):
+        # Files and other passthrough bodies go out untouched
+        if response.direct_passthrough:
+            return response
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        timing = g.get('response_timing', {'encode': 0.0})
+        compressible = (
+            200 <= response.status_code < 300
+            and response.status_code != 204
+            and response.mimetype in COMPRESSIBLE_MIMETYPES
+            and 'Content-Encoding' not in response.headers
+        )
+        encoding = self.negotiate() if compressible else None
+        if response.is_streamed:
+            response.response = self.compress_stream(
+                endpoint, encoding, response.response, timing)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if encoding is None or len(data) < self.min_size:
+                self.response_stats.record(
+                    endpoint, None, len(data), len(data), timing['encode'], 0.0)
+                return response
+            started = time.perf_counter()
+            compressed = self.compress(encoding, data)
+            self.response_stats.record(endpoint, encoding, len(data), len(
+                compressed), timing['encode'], time.perf_counter() - started)
+            response.set_data(compressed)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+            etag, weak = response.get_etag()
+            if etag:
+                response.set_etag(f"{etag}-{encoding}", weak)
+        if compressible:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def compress_stream(self, endpoint, encoding, chunks, timing):
+        compress, finish = self.stream_compressor(
+            encoding) if encoding else (None, None)
+        bytes_before = bytes_after = 0
+        compress_seconds = 0.0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                bytes_before += len(chunk)
+                if compress is not None:
+                    started = time.perf_counter()
+                    chunk = compress(chunk)
+                    compress_seconds += time.perf_counter() - started
+                bytes_after += len(chunk)
+                yield chunk
+            if finish is not None:
+                tail = finish()
+                bytes_after += len(tail)
+                yield tail
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.response_stats.record(
+                endpoint, encoding, bytes_before, bytes_after, timing['encode'], compress_seconds)
+
+    def stats(self):
+        return {
+            'encodings': content_encodings(),
+            'minSize': self.min_size,
+            'endpoints': self.response_stats.stats()
+        }
+
+
+_response_compressor = None
+_response_compressor_lock = threading.Lock()
+
+
+def get_response_compressor():
+    global _response_compressor
+    if _response_compressor is None:
+        with _response_compressor_lock:
+            if _response_compressor is None:
+                _response_compressor = ResponseCompressor.from_env()
+    return _response_compressor
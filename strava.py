@@ -1,19 +1,44 @@
 from __future__ import print_function
 import os
+import signal
+import sys
 from pprint import pprint
 from dotenv import load_dotenv, find_dotenv
-from flask import Flask
-from data_utilities import data_controller_bp
-from auth_utilities import auth_controller_bp
+from flask import Flask, Response, make_response, jsonify, request
+from data_utilities import data_controller_bp, strava_executor, dynamodb_executor
+from auth_utilities import auth_controller_bp, refresh_executor
+from report_utilities import report_controller_bp
+from webhook_utilities import webhook_controller_bp, get_webhook_queue
+from strava_client import get_strava_client, waitress_threads, StravaUnavailableError
+from token_cache import get_token_cache
+from write_behind import get_write_behind_queue
+from response_pipeline import get_response_compressor
+from metrics import get_metrics
+from profiling import get_request_profiler, PROFILE_HEADER
+from jobs import get_job_registry
 from flask_cors import CORS
 
 load_dotenv(find_dotenv())
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+get_response_compressor().init_app(app)
+get_metrics().init_app(app)
+get_request_profiler().init_app(app)
 
 app.register_blueprint(data_controller_bp)
 app.register_blueprint(auth_controller_bp)
+app.register_blueprint(report_controller_bp)
+app.register_blueprint(webhook_controller_bp)
+
+
+@app.errorhandler(StravaUnavailableError)
+def handle_strava_unavailable(e):
+    # Anything without a cached fallback fails fast while Strava is degraded
+    response = make_response(jsonify({'error': str(e)}), 503)
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
 
 
 @app.route('/srg/healthcheck', methods=["GET"])
@@ -21,10 +46,127 @@ def return_healthy():
     return 'healthy!'
 
 
+def executor_saturation():
+    # Busy workers and queued tasks per pool, queued > 0 means saturated
+    executors = {
+        'strava': strava_executor,
+        'dynamodb': dynamodb_executor,
+        'tokenRefresh': refresh_executor,
+        'jobs': get_job_registry().executor
+    }
+    saturation = {}
+    for name, executor in executors.items():
+        idle = getattr(getattr(executor, '_idle_semaphore', None), '_value', 0)
+        saturation[(name, 'maxWorkers')] = executor._max_workers
+        saturation[(name, 'busy')] = len(executor._threads) - idle
+        saturation[(name, 'queued')] = executor._work_queue.qsize()
+    return saturation
+
+
+def queue_depths():
+    depths = {}
+    for name, queue in {'writeBehind': get_write_behind_queue(), 'webhook': get_webhook_queue()}.items():
+        stats = queue.stats()
+        depths[(name, 'pending')] = stats['depth']
+        depths[(name, 'inFlight')] = stats['inFlight']
+        depths[(name, 'maxPending')] = stats['maxPending']
+    return depths
+
+
+def strava_budget():
+    stats = get_strava_client().rate_limiter.stats()
+    return {(window, field): stats[key][field]
+            for window, key in [('short', 'shortWindow'), ('daily', 'dailyWindow')]
+            for field in ['limit', 'usage']}
+
+
+metrics = get_metrics()
+metrics.gauge('srg_waitress_threads', 'Request threads waitress runs with',
+              (), lambda: {(): waitress_threads()})
+metrics.gauge('srg_executor_threads', 'Thread pool workers and backlog',
+              ('pool', 'state'), executor_saturation)
+metrics.gauge('srg_queue_items', 'Write-behind and webhook queue depth',
+              ('queue', 'state'), queue_depths)
+metrics.gauge('srg_strava_rate_limit', 'Strava budget as last reported by Strava',
+              ('window', 'field'), strava_budget)
+metrics.gauge('srg_strava_breaker_state', 'Strava circuit breaker, 1 for the current state',
+              ('state',), lambda: {(state,): int(get_strava_client().breaker_stats()['state'] == state)
+                                   for state in ['closed', 'open', 'half_open']})
+metrics.gauge('srg_strava_breaker_short_circuited', 'Strava calls refused while the circuit was open',
+              (), lambda: {(): get_strava_client().breaker_stats().get('shortCircuited', 0)})
+metrics.gauge('srg_token_cache_entries', 'Cached access tokens',
+              (), lambda: {(): get_token_cache().stats()['size']})
+
+
+@app.route('/srg/metrics', methods=["GET"])
+def return_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/srg/stravaPoolStats', methods=["GET"])
+def return_strava_pool_stats():
+    return get_strava_client().pool_stats()
+
+
+@app.route('/srg/stravaRateLimit', methods=["GET"])
+def return_strava_rate_limit():
+    return get_strava_client().rate_limiter.stats()
+
+
+@app.route('/srg/stravaBreaker', methods=["GET"])
+def return_strava_breaker():
+    return get_strava_client().breaker_stats()
+
+
+@app.route('/srg/tokenCacheStats', methods=["GET"])
+def return_token_cache_stats():
+    return get_token_cache().stats()
+
+
+@app.route('/srg/writeBehindStats', methods=["GET"])
+def return_write_behind_stats():
+    return get_write_behind_queue().stats()
+
+
+@app.route('/srg/webhookQueueStats', methods=["GET"])
+def return_webhook_queue_stats():
+    return get_webhook_queue().stats()
+
+
+@app.route('/srg/responseStats', methods=["GET"])
+def return_response_stats():
+    return get_response_compressor().stats()
+
+
+@app.route('/srg/profiles', methods=["GET"])
+def return_profiles():
+    profiler = get_request_profiler()
+    if not profiler.authorized(request.headers.get(PROFILE_HEADER)):
+        return make_response(jsonify({'error': 'Forbidden'}), 403)
+    return profiler.stats()
+
+
+@app.route('/srg/profiles/<profile_id>', methods=["GET"])
+def return_profile(profile_id):
+    profiler = get_request_profiler()
+    if not profiler.authorized(request.headers.get(PROFILE_HEADER)):
+        return make_response(jsonify({'error': 'Forbidden'}), 403)
+    profile = profiler.get(profile_id)
+    if profile is None:
+        return make_response(jsonify({'error': 'Profile Not Found'}), 404)
+    # collapsed is flamegraph.pl / speedscope input
+    if request.args.get('format') == 'collapsed':
+        return Response(profile.sampler.collapsed(), mimetype='text/plain')
+    return profile.summary(request.args.get('top', profiler.top, type=int))
+
+
 if __name__ == '__main__':
     env = os.environ.get('FLASK_ENVIRONMENT')
+    # Exit normally on SIGTERM so atexit flushes queued writes before the
+    # task is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     if env == 'production':
         from waitress import serve
-        serve(app, host="0.0.0.0", port=5000)
+        serve(app, host="0.0.0.0", port=5000, threads=waitress_threads())
     else:
         app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,225 @@
+import http.cookiejar
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import StravaRateLimiter, RateLimitError, INTERACTIVE, BULK
+from circuit_breaker import CircuitBreaker
+from metrics import get_metrics, strava_operation
+
+# Overridable so benchmarks can point the app at a local fake
+STRAVA_API_URL = os.environ.get(
+    'STRAVA_API_URL', 'https://www.strava.com/api/v3')
+
+
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+def waitress_threads():
+    return int(os.environ.get('WAITRESS_THREADS', 4))
+
+
+class StravaUnavailableError(Exception):
+    # Strava is failing or the circuit is open, retry_after is in seconds
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class StravaClient:
+    def __init__(self, pool_size, connect_timeout, read_timeout, rate_limiter=None, breaker=None, max_retries=2, deadlines=None):
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.timeout = (connect_timeout, read_timeout)
+        # GETs are retried, everything else goes out once
+        self.max_retries = max_retries
+        # Total seconds a call may take including retries, per priority
+        self.deadlines = deadlines or {INTERACTIVE: 10.0, BULK: 60.0}
+        self.session = requests.Session()
+        # Every athlete shares this session, a cookie one response sets must
+        # never ride along on another athlete's request
+        self.session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        # One pool per host; Strava only needs a couple (api + oauth)
+        self.adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            pool_block=False
+        )
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    @classmethod
+    def from_env(cls):
+        # Leave headroom above the waitress threads for the bulk sync executors
+        pool_size = int(os.environ.get(
+            'STRAVA_POOL_SIZE', waitress_threads() + 10))
+        connect_timeout = float(os.environ.get('STRAVA_CONNECT_TIMEOUT', 3.05))
+        read_timeout = float(os.environ.get('STRAVA_READ_TIMEOUT', 30))
+        breaker = CircuitBreaker(
+            failure_threshold=int(os.environ.get(
+                'STRAVA_BREAKER_FAILURES', 5)),
+            reset_timeout=float(os.environ.get('STRAVA_BREAKER_RESET', 30))
+        )
+        deadlines = {
+            INTERACTIVE: float(os.environ.get('STRAVA_INTERACTIVE_DEADLINE', 10)),
+            BULK: float(os.environ.get('STRAVA_BULK_DEADLINE', 60))
+        }
+        return cls(pool_size, connect_timeout, read_timeout,
+                   StravaRateLimiter.from_env(), breaker,
+                   int(os.environ.get('STRAVA_MAX_RETRIES', 2)), deadlines)
+
+    def _headers(self, access_token, headers):
+        headers = dict(headers or {})
+        if access_token is not None:
+            headers['Authorization'] = f"Bearer { access_token }"
+        return headers
+
+    def _acquire(self, priority, metrics):
+        if self.rate_limiter is None:
+            return
+        started = time.perf_counter()
+        try:
+            self.rate_limiter.acquire(priority)
+        except RateLimitError:
+            metrics.rate_limited.inc('budget')
+            raise
+        # Bulk callers can spend a while here being paced
+        metrics.record_dependency(
+            'strava_wait', priority, time.perf_counter() - started)
+
+    def _allow(self):
+        if self.breaker is not None and not self.breaker.allow():
+            raise StravaUnavailableError(
+                'Strava Unavailable', self.breaker.retry_after())
+
+    def _record(self, failed):
+        if self.breaker is not None:
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def _release(self):
+        # The call says nothing about Strava, free a half-open probe
+        if self.breaker is not None:
+            self.breaker.cancel()
+
+    def _send(self, method, url, access_token, headers, operation, metrics, expires, rate_limited, kwargs):
+        # One attempt, None when the connection failed or timed out
+        remaining = expires - time.monotonic()
+        timeout = kwargs.get('timeout') or (
+            min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+        started = time.perf_counter()
+        try:
+            response = getattr(self.session, method)(
+                url, headers=self._headers(access_token, headers), **{**kwargs, 'timeout': timeout})
+        except requests.Timeout:
+            # Only a timeout Strava had the full allowance for is its fault,
+            # one cut short by our deadline isn't
+            if kwargs.get('timeout') or remaining >= self.timeout[1]:
+                self._record(True)
+            else:
+                self._release()
+            return None
+        except requests.RequestException:
+            # Refused connections, but also truncated or undecodable bodies
+            self._record(True)
+            return None
+        except BaseException:
+            # Says nothing about Strava, but a half-open probe must not stay
+            # claimed or the circuit never closes again
+            self._release()
+            raise
+        finally:
+            metrics.record_dependency(
+                'strava', operation, time.perf_counter() - started)
+        status_code = getattr(response, 'status_code', None)
+        self._record(status_code in RETRY_STATUSES)
+        if status_code == 429:
+            metrics.rate_limited.inc('strava')
+        if rate_limited and self.rate_limiter is not None:
+            self.rate_limiter.update(response)
+        return response
+
+    def _request(self, method, url, access_token, headers, priority, deadline=None, rate_limited=True, **kwargs):
+        # rate_limited=False is for oauth, which isn't metered like the API
+        # and sends no usage headers to pace against
+        metrics = get_metrics()
+        operation = strava_operation(method, url)
+        expires = None
+        attempts = self.max_retries + 1 if method == 'get' else 1
+        response = None
+        for attempt in range(attempts):
+            if attempt:
+                # Full jitter, and never past the deadline
+                delay = random.uniform(0, min(2.0, 0.2 * 2 ** attempt))
+                if time.monotonic() + delay >= expires:
+                    break
+                metrics.retries.inc('strava', operation)
+                time.sleep(delay)
+            if rate_limited:
+                self._acquire(priority, metrics)
+            if expires is None:
+                # Bulk calls can be paced by our own budget for minutes, the
+                # deadline only covers time spent on Strava
+                expires = time.monotonic() + \
+                    (deadline or self.deadlines[priority])
+            elif time.monotonic() >= expires:
+                break
+            self._allow()
+            response = self._send(method, url, access_token, headers,
+                                  operation, metrics, expires, rate_limited, kwargs)
+            if response is not None and getattr(response, 'status_code', None) not in RETRY_STATUSES:
+                return response
+        # Out of attempts or time with nothing usable, callers shouldn't
+        # parse an error page
+        raise StravaUnavailableError('Strava Unavailable', self.breaker.retry_after(
+        ) if self.breaker is not None else 0)
+
+    def get(self, url, access_token=None, headers=None, priority=INTERACTIVE, **kwargs):
+        return self._request('get', url, access_token, headers, priority, **kwargs)
+
+    def put(self, url, access_token=None, headers=None, priority=INTERACTIVE, **kwargs):
+        return self._request('put', url, access_token, headers, priority, **kwargs)
+
+    def post(self, url, access_token=None, headers=None, priority=INTERACTIVE, **kwargs):
+        return self._request('post', url, access_token, headers, priority, **kwargs)
+
+    def breaker_stats(self):
+        return self.breaker.stats() if self.breaker is not None else {'state': 'disabled'}
+
+    def pool_stats(self):
+        # urllib3 counts every request and every newly opened connection per
+        # host pool, a request that didn't open a connection reused one
+        requests_made = 0
+        connections_opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            connections_opened += pool.num_connections
+        return {
+            'poolSize': self.pool_size,
+            'requests': requests_made,
+            'hits': max(requests_made - connections_opened, 0),
+            'misses': connections_opened
+        }
+
+
+_strava_client = None
+_strava_client_lock = threading.Lock()
+
+
+def get_strava_client():
+    global _strava_client
+    if _strava_client is None:
+        with _strava_client_lock:
+            if _strava_client is None:
+                _strava_client = StravaClient.from_env()
+    return _strava_client
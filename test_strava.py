@@ -1,11 +1,30 @@
 import boto3
+import gzip
 import json
 import pytest
+import requests
+import responses
+import threading
+import time
+from decimal import Decimal
 from pprint import pprint
-from auth_utilities import fetch_tokens, upsert_tokens, refresh_tokens
+from auth_utilities import fetch_tokens, upsert_tokens, refresh_tokens, get_access_token_from_athlete_id
+from token_cache import get_token_cache
+from dynamo_utilities import get_table
+from write_behind import WriteBehindQueue, get_write_behind_queue
+from activity_codec import encode_blob, decode_blob
+from response_pipeline import get_response_compressor
+from metrics import get_metrics
+from profiling import get_request_profiler
 from moto import mock_dynamodb
+from strava_client import StravaClient, StravaUnavailableError
+from circuit_breaker import CircuitBreaker
+from strava import app
+from webhook_utilities import get_webhook_queue
+from rate_limiter import StravaRateLimiter, RateLimitError, BULK, INTERACTIVE
 from unittest import mock
-from data_utilities import fetch_all_activities_strava_req,                fetch_all_activities_req, fetch_individual_entry_req, upload_individual_entry_data_to_db, destroy_user_req, update_one_activity_req, put_activity_update_req, fetch_entry_kudoers_req, destroy_user_tokens_req, save_user_settings_req, get_user_settings_req, fetch_general_individual_entry
+from concurrent.futures import ThreadPoolExecutor
+from data_utilities import get_sync_checkpoint_req, save_sync_checkpoint_req, update_cached_kudos_comments, add_all_activities_req, ingest_activities, iter_activity_pages_strava, get_sync_watermark_req, fetch_all_activities_strava_req,                fetch_all_activities_req, fetch_individual_entry_req, upload_individual_entry_data_to_db, destroy_user_req, update_one_activity_req, put_activity_update_req, fetch_entry_kudoers_req, destroy_user_tokens_req, save_user_settings_req, get_user_settings_req, fetch_general_individual_entry, StravaError
 
 
 def create_token_table():
@@ -39,35 +58,63 @@ def create_activities_table():
     return table
 
 
+def create_activity_streams_table():
+    dynamodb = boto3.resource('dynamodb')
+    table_name = 'srg-activity-streams-table'
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {'AttributeName': 'athleteId', 'KeyType': 'HASH'},
+            {'AttributeName': 'activityId', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'athleteId', 'AttributeType': 'S'},
+            {'AttributeName': 'activityId', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return table
+
+
 def mocked_requests_get(*args, **kwargs):
     class MockResponse:
         def __init__(self, json_data, status_code):
             self.json_data = json_data
             self.status_code = status_code
+            self.headers = {}
 
         def json(self):
             return self.json_data
 
+    url = args[0] if args else kwargs.get('url', '')
+
     # Entry Kudos Test
-    if args and args[0].startswith('https://www.strava.com/api/v3/activities/12345/kudos'):
+    if url.startswith('https://www.strava.com/api/v3/activities/12345/kudos'):
         with open('testing_fixtures/fetch_entry_kudos.json', 'r') as file:
             mock_data = json.load(file)
         return MockResponse(mock_data, 200)
-    elif 'url' in kwargs and kwargs['url'].startswith('https://www.strava.com/api/v3/oauth/token'):
+    elif url.startswith('https://www.strava.com/api/v3/oauth/token'):
         with open('testing_fixtures/refresh_token_strava.json', 'r') as file:
             mock_data = json.load(file)
         return MockResponse(mock_data, 200)
-    elif args and args[0].startswith('https://www.strava.com/api/v3/activities/12345?name=testname&description=testdescription'):
+    elif url.startswith('https://www.strava.com/api/v3/activities/12345?name=testname&description=testdescription'):
         with open('testing_fixtures/update_one_activity_strava.json', 'r') as file:
             mock_data = json.load(file)
         return MockResponse(mock_data, 200)
+    # Activity Stream Test
+    elif url.startswith('https://www.strava.com/api/v3/activities/13579/streams'):
+        return MockResponse({
+            'latlng': {'data': [[40.0 + i / 1000, -105.0 - i / 1000] for i in range(1000)], 'series_type': 'distance', 'original_size': 1000, 'resolution': 'high'},
+            'time': {'data': list(range(1000)), 'series_type': 'distance', 'original_size': 1000, 'resolution': 'high'},
+            'distance': {'data': [float(i) for i in range(1000)], 'series_type': 'distance', 'original_size': 1000, 'resolution': 'high'}
+        }, 200)
     # Individual Entry Test
-    elif args and args[0].startswith('https://www.strava.com/api/v3/activities/1624305483'):
+    elif url.startswith('https://www.strava.com/api/v3/activities/1624305483'):
         with open('testing_fixtures/fetch_individual_entry_strava.json', 'r') as file:
             mock_data = json.load(file)
         return MockResponse(mock_data, 200)
     # All Activities Test
-    elif args and args[0].startswith('https://www.strava.com/api/v3/activities'):
+    elif url.startswith('https://www.strava.com/api/v3/activities'):
         with open('testing_fixtures/fetch_all_activities_strava.json', 'r') as file:
             mock_data = json.load(file)
         return MockResponse(mock_data, 200)
@@ -75,14 +122,19 @@ def mocked_requests_get(*args, **kwargs):
     return MockResponse(None, 404)
 
 
-@mock.patch('requests.get', side_effect=mocked_requests_get)
+def fresh_strava_client():
+    # The shared client's budget and breaker carry over between tests
+    return mock.patch('strava_client._strava_client', StravaClient.from_env())
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
 def test_fetch_all_strava_activities(self):
     all_activities = fetch_all_activities_strava_req('123456789', 1)
     assert "resource_state" in all_activities[0]
 
 
 # Strava Test
-@mock.patch('requests.get', side_effect=mocked_requests_get)
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
 def test_fetch_individual_entry_from_strava(self):
     individual_entry = fetch_individual_entry_req('1624305483', '24680')
     assert "resource_state" in individual_entry
@@ -141,7 +193,7 @@ def test_upload_individual_entry_data_to_db():
     assert 'mapPolyline' in result
 
 
-@mock.patch('requests.get', side_effect=mocked_requests_get)
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
 def test_fetch_kudoers(self):
     kudoers = fetch_entry_kudoers_req('12345', '54321')
     assert len(kudoers) == 2
@@ -151,7 +203,7 @@ def test_fetch_kudoers(self):
 ###### Tests! ######
 
 
-@mock.patch('requests.put', side_effect=mocked_requests_get)
+@mock.patch('requests.Session.put', side_effect=mocked_requests_get)
 def test_update_entry_in_strava(self):
     test = put_activity_update_req(
         access_token='accessToken',
@@ -162,7 +214,7 @@ def test_update_entry_in_strava(self):
     assert 'achievement_count' in test
 
 
-@mock.patch('requests.post', side_effect=mocked_requests_get)
+@mock.patch('requests.Session.post', side_effect=mocked_requests_get)
 @mock_dynamodb
 def test_refresh_tokens(self):
     table = create_token_table()
@@ -377,6 +429,7 @@ def test_destroy_user():
     activities = activities['Items']
     assert len(activities) == 2
     response = destroy_user_req('123456789')
+    assert response == 2
     activities = table.scan()
     activities = activities['Items']
     assert len(activities) == 0
@@ -443,3 +496,949 @@ def test_fetch_shared_activity():
     assert 'description' in response
     #
     assert not 'mapPolyline' in response
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+def test_strava_client_shares_auth_and_timeout(mock_get):
+    client = StravaClient(pool_size=4, connect_timeout=1, read_timeout=2)
+    client.get('https://www.strava.com/api/v3/activities/12345/kudos',
+               access_token='accessToken')
+    kwargs = mock_get.call_args.kwargs
+    assert kwargs['headers']['Authorization'] == 'Bearer accessToken'
+    assert kwargs['timeout'] == (1, 2)
+
+
+def test_strava_client_pool_stats():
+    client = StravaClient(pool_size=4, connect_timeout=1, read_timeout=2)
+    stats = client.pool_stats()
+    assert stats['poolSize'] == 4
+    assert stats['hits'] == 0
+    assert stats['misses'] == 0
+
+
+def test_rate_limiter_tracks_strava_headers():
+    limiter = StravaRateLimiter(200, 2000, 0.2, 0)
+
+    class Response:
+        status_code = 200
+        headers = {'X-RateLimit-Limit': '100,1000',
+                   'X-RateLimit-Usage': '40,500'}
+    limiter.update(Response())
+    stats = limiter.stats()
+    assert stats['shortWindow']['limit'] == 100
+    assert stats['shortWindow']['usage'] == 40
+    assert stats['dailyWindow']['limit'] == 1000
+    assert stats['dailyWindow']['usage'] == 500
+
+
+def test_rate_limiter_reserves_budget_for_interactive_calls():
+    limiter = StravaRateLimiter(10, 2000, 0.2, 0)
+    limiter.short_window.usage = 8
+    # Bulk callers can't touch the interactive reserve
+    with pytest.raises(RateLimitError):
+        limiter.acquire(BULK)
+    limiter.acquire(INTERACTIVE)
+    limiter.acquire(INTERACTIVE)
+    with pytest.raises(RateLimitError):
+        limiter.acquire(INTERACTIVE)
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_add_all_activities_incremental_sync(mock_get):
+    create_token_table()
+    activities_table = create_activities_table()
+    assert add_all_activities_req('accessToken', '19812306') == 1
+    assert 'after' not in mock_get.call_args.kwargs['params']
+    assert activities_table.scan()['Count'] == 1
+    # 2023-11-27T15:46:41Z
+    assert get_sync_watermark_req('19812306') == 1701100001
+
+    add_all_activities_req('accessToken', '19812306')
+    assert mock_get.call_args.kwargs['params']['after'] == 1701100000
+
+    add_all_activities_req('accessToken', '19812306', full_resync=True)
+    assert 'after' not in mock_get.call_args.kwargs['params']
+
+
+def test_iter_activity_pages_prefetches_until_short_page():
+    pages = {1: [{'id': i} for i in range(200)], 2: [{'id': 200}]}
+
+    def fetch_page(access_token, page, priority, after):
+        return pages.get(page, [])
+    with mock.patch('data_utilities.fetch_activities_page_strava_req', side_effect=fetch_page):
+        result = list(iter_activity_pages_strava(
+            'accessToken', prefetch=3))
+    assert len(result) == 2
+    assert len(result[0]) == 200
+    assert result[1][0]['id'] == 200
+
+    # A short first page is the only call
+    with mock.patch('data_utilities.fetch_activities_page_strava_req', return_value=[{'id': 1}]) as fetch:
+        assert list(iter_activity_pages_strava(
+            'accessToken', prefetch=3)) == [[{'id': 1}]]
+    assert fetch.call_count == 1
+
+
+@mock_dynamodb
+def test_ingest_activities_writes_only_changed_items():
+    table = create_activities_table()
+    with open('testing_fixtures/fetch_all_activities_strava.json', 'r') as file:
+        activities = json.load(file)
+    assert ingest_activities(activities) == 1
+    # Unchanged activities are skipped
+    assert ingest_activities(activities) == 0
+
+    table.update_item(
+        Key={'athleteId': '19812306', 'activityId': '10295631901'},
+        UpdateExpression='SET individualActivityCached = :cached',
+        ExpressionAttributeValues={':cached': True}
+    )
+    activities[0]['kudos_count'] = 5
+    assert ingest_activities(activities) == 1
+    item = table.scan()['Items'][0]
+    assert item['kudos_count'] == 5
+    # Cached detail attributes survive the rewrite
+    assert item['individualActivityCached'] == True
+
+
+@mock_dynamodb
+def test_all_activities_endpoint_streams_and_pages():
+    table = create_activities_table()
+    for activity_id in ['1', '2', '3']:
+        table.put_item(Item={'athleteId': '123456789',
+                       'activityId': activity_id, 'distance': Decimal('1.5')})
+    client = app.test_client()
+
+    response = client.get('/srg/allActivities?srg_athlete_id=123456789')
+    assert response.is_streamed
+    assert [item['activityId'] for item in response.get_json()] == [
+        '1', '2', '3']
+
+    response = client.get(
+        '/srg/allActivities?srg_athlete_id=123456789&limit=2')
+    assert len(response.get_json()) == 2
+    assert response.headers['X-Next-Cursor'] == '2'
+
+    response = client.get(
+        '/srg/allActivities?srg_athlete_id=123456789&limit=2&cursor=2')
+    assert [item['activityId'] for item in response.get_json()] == ['3']
+    assert 'X-Next-Cursor' not in response.headers
+
+
+@mock_dynamodb
+def test_all_activities_endpoint_projects_fields():
+    table = create_activities_table()
+    table.put_item(Item={'athleteId': '123456789', 'activityId': '1',
+                   'name': 'Morning Run', 'type': 'Run', 'segmentEfforts': '[]'})
+    client = app.test_client()
+
+    response = client.get('/srg/allActivities?srg_athlete_id=123456789')
+    item = response.get_json()[0]
+    assert item['name'] == 'Morning Run'
+    assert 'segmentEfforts' not in item
+
+    response = client.get(
+        '/srg/allActivities?srg_athlete_id=123456789&fields=type')
+    assert response.get_json() == [
+        {'athleteId': '123456789', 'activityId': '1', 'type': 'Run'}]
+
+    response = client.get(
+        '/srg/allActivities?srg_athlete_id=123456789&fields=all')
+    assert 'segmentEfforts' in response.get_json()[0]
+
+    response = client.get(
+        '/srg/allActivities?srg_athlete_id=123456789&fields=a.b')
+    assert response.status_code == 400
+
+
+@mock_dynamodb
+def test_access_token_cache():
+    table = create_token_table()
+    table.put_item(Item={
+        'athleteId': '123456789',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    token_cache = get_token_cache()
+    token_cache.invalidate('123456789')
+    assert get_access_token_from_athlete_id('123456789') == '13579'
+    hits = token_cache.stats()['hits']
+    with mock.patch('auth_utilities.fetch_tokens') as mock_fetch_tokens:
+        assert get_access_token_from_athlete_id('123456789') == '13579'
+        assert not mock_fetch_tokens.called
+    assert token_cache.stats()['hits'] == hits + 1
+
+    upsert_tokens(tokens={
+        'athlete_id': '123456789',
+        'access_token': '97531',
+        'refresh_token': '24680',
+        'expires_at': 4102444800
+    })
+    assert get_access_token_from_athlete_id('123456789') == '97531'
+    destroy_user_tokens_req('123456789')
+    assert token_cache.get('123456789') is None
+
+
+@mock_dynamodb
+def test_concurrent_expired_token_refreshes_once():
+    table = create_token_table()
+    table.put_item(Item={
+        'athleteId': '123456789',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 0
+    })
+    get_token_cache().invalidate('123456789')
+
+    def slow_refresh(athlete_id, refresh_token):
+        time.sleep(0.2)
+        get_token_cache().put(athlete_id, {
+            'accessToken': '97531',
+            'refreshToken': '24680',
+            'expiresAt': 4102444800
+        })
+        return '97531'
+    results = []
+    with mock.patch('auth_utilities.refresh_tokens', side_effect=slow_refresh) as mock_refresh:
+        threads = [threading.Thread(target=lambda: results.append(
+            get_access_token_from_athlete_id('123456789'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert mock_refresh.call_count == 1
+    assert results == ['97531'] * 5
+
+
+@mock_dynamodb
+def test_token_near_expiry_refreshes_in_background():
+    table = create_token_table()
+    table.put_item(Item={
+        'athleteId': '123456789',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': int(time.time()) + 300
+    })
+    get_token_cache().invalidate('123456789')
+    refreshed = threading.Event()
+    with mock.patch('auth_utilities.refresh_tokens', side_effect=lambda *args: refreshed.set()):
+        # The current token is still served while the refresh runs
+        assert get_access_token_from_athlete_id('123456789') == '13579'
+        assert refreshed.wait(5)
+
+
+@mock_dynamodb
+def test_queued_background_refreshes_are_coalesced():
+    get_token_cache().put('123456789', {
+        'accessToken': 'a', 'refreshToken': 'r', 'expiresAt': int(time.time()) + 300})
+    busy = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    executor.submit(busy.wait, 5)
+    refresh_calls = []
+
+    def refresh(athlete_id, refresh_token):
+        refresh_calls.append(refresh_token)
+        get_token_cache().put(athlete_id, {
+            'accessToken': 'a2', 'refreshToken': 'r2', 'expiresAt': int(time.time()) + 6 * 3600})
+        return 'a2'
+    with mock.patch('auth_utilities.refresh_executor', executor), mock.patch('auth_utilities.refresh_tokens', side_effect=refresh):
+        for _ in range(5):
+            assert get_access_token_from_athlete_id('123456789') == 'a'
+        busy.set()
+        executor.shutdown(wait=True)
+        # A refresh scheduled behind one that already landed does nothing
+        get_token_cache().put('123456789', {
+            'accessToken': 'a', 'refreshToken': 'r', 'expiresAt': int(time.time()) + 300})
+        schedule = ThreadPoolExecutor(max_workers=1)
+        with mock.patch('auth_utilities.refresh_executor', schedule):
+            blocker = threading.Event()
+            schedule.submit(blocker.wait, 5)
+            get_access_token_from_athlete_id('123456789')
+            get_token_cache().put('123456789', {
+                'accessToken': 'a3', 'refreshToken': 'r3', 'expiresAt': int(time.time()) + 6 * 3600})
+            blocker.set()
+            schedule.shutdown(wait=True)
+    assert refresh_calls == ['r']
+    get_token_cache().invalidate('123456789')
+
+
+def test_tables_are_reused_per_thread():
+    table = get_table('srg-activities-table')
+    assert get_table('srg-activities-table') is table
+    other_thread_tables = []
+    thread = threading.Thread(target=lambda: other_thread_tables.append(
+        get_table('srg-activities-table')))
+    thread.start()
+    thread.join()
+    assert other_thread_tables[0] is not table
+
+
+@mock_dynamodb
+def test_destroy_user_endpoint_runs_as_job():
+    tokens_table = create_token_table()
+    tokens_table.put_item(Item={'athleteId': '123456789'})
+    streams_table = create_activity_streams_table()
+    streams_table.put_item(
+        Item={'athleteId': '123456789', 'activityId': '1', 'streams': {}})
+    table = create_activities_table()
+    for activity_id in range(60):
+        table.put_item(Item={'athleteId': '123456789',
+                       'activityId': str(activity_id)})
+    client = app.test_client()
+    response = client.get('/srg/destroyUser?srg_athlete_id=123456789')
+    assert response.status_code == 202
+    job_id = response.get_json()['jobId']
+
+    for _ in range(100):
+        status = client.get(f'/srg/jobStatus/{job_id}').get_json()
+        if status['status'] in ('succeeded', 'failed'):
+            break
+        time.sleep(0.05)
+    assert status['status'] == 'succeeded'
+    assert status['progress'] == {'found': 61, 'deleted': 61}
+    assert table.scan()['Count'] == 0
+    assert streams_table.scan()['Count'] == 0
+    assert tokens_table.scan()['Count'] == 0
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_individual_entry_served_from_cache(mock_get):
+    create_token_table().put_item(Item={
+        'athleteId': '24680',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    create_activities_table()
+    client = app.test_client()
+    url = '/srg/individualEntry/1624305483?srg_athlete_id=24680'
+
+    response = client.get(url)
+    assert 'resource_state' in response.get_json()
+    assert mock_get.call_count == 1
+    assert get_write_behind_queue().flush(5)
+
+    # Second read comes from DynamoDB in the generalIndividualEntry shape
+    response = client.get(url)
+    assert mock_get.call_count == 1
+    cached = response.get_json()
+    assert cached['activityId'] == '1624305483'
+    assert 'polyline' in cached['map']
+
+    client.get(url + '&refresh=true')
+    assert mock_get.call_count == 2
+    # Don't let the refreshed write land in another test's tables
+    assert get_write_behind_queue().flush(5)
+
+
+@fresh_strava_client()
+@mock_dynamodb
+def test_individual_entry_error_bodies_are_not_cached():
+    create_token_table().put_item(Item={
+        'athleteId': '24680',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    table = create_activities_table()
+    client = app.test_client()
+    url = '/srg/individualEntry/999?srg_athlete_id=24680'
+    not_found = mock.Mock(status_code=404, headers={})
+    not_found.json.return_value = {'message': 'Record Not Found', 'errors': [
+        {'resource': 'Activity', 'field': 'id', 'code': 'invalid'}]}
+    rate_limited = mock.Mock(status_code=429, headers={})
+    rate_limited.json.return_value = {'message': 'Rate Limit Exceeded', 'errors': [
+        {'resource': 'Application', 'field': 'rate limit', 'code': 'exceeded'}]}
+    with mock.patch('requests.Session.get', side_effect=[not_found, rate_limited]):
+        assert client.get(url).get_json()['message'] == 'Record Not Found'
+        assert client.get(url).status_code == 429
+    assert get_write_behind_queue().flush(5)
+    assert table.scan()['Count'] == 0
+
+
+def test_activity_blob_round_trip():
+    laps = [{'lap_index': i, 'distance': 1000.0} for i in range(50)]
+    encoded = encode_blob(laps)
+    assert isinstance(encoded, bytes)
+    assert len(encoded) < len(json.dumps(laps))
+    assert decode_blob(encoded) == laps
+    # Legacy string-encoded attributes still decode
+    assert decode_blob(json.dumps(laps)) == laps
+
+
+@mock_dynamodb
+def test_general_individual_entry_decodes_compressed_blobs():
+    table = create_activities_table()
+    table.put_item(Item={'athleteId': '123456789', 'activityId': '987654321'})
+    with open('testing_fixtures/fetch_individual_entry_strava.json', 'r') as file:
+        data = json.load(file)
+    upload_individual_entry_data_to_db(data, '123456789', '987654321')
+
+    response = fetch_general_individual_entry('123456789', '987654321')
+    assert response['segment_efforts'] == data['segment_efforts']
+    assert response['best_efforts'] == data['best_efforts']
+    assert response['laps'] == data.get('laps', [])
+
+    response = fetch_general_individual_entry(
+        '123456789', '987654321', ['laps'])
+    assert response['laps'] == data.get('laps', [])
+    assert 'segment_efforts' not in response
+    assert 'best_efforts' not in response
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_activity_stream_cached_and_downsampled(mock_get):
+    create_token_table().put_item(Item={
+        'athleteId': '24680',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    create_activity_streams_table()
+    client = app.test_client()
+    url = '/srg/activityStream/13579?srg_athlete_id=24680&keys=latlng,time'
+
+    response = client.get(url).get_json()
+    assert set(response.keys()) == {'latlng', 'time'}
+    assert len(response['latlng']['data']) == 1000
+    assert mock_get.call_count == 1
+    assert get_write_behind_queue().flush(5)
+
+    response = client.get(url + '&points=100').get_json()
+    assert mock_get.call_count == 1
+    assert len(response['latlng']['data']) == 100
+    assert len(response['time']['data']) == 100
+    assert response['latlng']['data'][0] == [40.0, -105.0]
+    assert response['time']['data'][-1] == 999
+
+    # A miss on another key keeps what's cached
+    client.get('/srg/activityStream/13579?srg_athlete_id=24680&keys=altitude')
+    requested = mock_get.call_args.args[0].split('keys=')[1].split('&')[0]
+    assert set(requested.split(',')) == {
+        'altitude', 'latlng', 'time', 'distance'}
+    assert get_write_behind_queue().flush(5)
+    client.get(url)
+    assert mock_get.call_count == 2
+
+
+@mock_dynamodb
+def test_report_filters_sorts_and_totals():
+    table = create_activities_table()
+    activities = [
+        ('1', 'Run', '2023-11-27T15:46:41Z', '5000', 1500, '10'),
+        ('2', 'Run', '2023-11-29T15:46:41Z', '10000', 3600, '50'),
+        ('3', 'Ride', '2023-11-30T15:46:41Z', '40000', 3600, '300'),
+        ('4', 'Run', '2023-12-05T15:46:41Z', '8000', 2000, '20'),
+        ('5', 'Run', '2024-01-02T15:46:41Z', '3000', 0, '0')
+    ]
+    for activity_id, sport, start_date, distance, moving_time, elevation in activities:
+        table.put_item(Item={
+            'athleteId': '123456789',
+            'activityId': activity_id,
+            'type': sport,
+            'start_date': start_date,
+            'distance': Decimal(distance),
+            'moving_time': moving_time,
+            'total_elevation_gain': Decimal(elevation)
+        })
+    client = app.test_client()
+
+    report = client.get(
+        '/srg/report?srg_athlete_id=123456789&sport=Run&sort=pace&page_size=2&period=month').get_json()
+    assert report['total'] == 4
+    assert [a['activityId'] for a in report['activities']] == ['4', '1']
+    assert report['totals'] == [
+        {'period': '2023-11', 'count': 2, 'distance': 15000.0,
+            'moving_time': 5100.0, 'total_elevation_gain': 60.0},
+        {'period': '2023-12', 'count': 1, 'distance': 8000.0,
+            'moving_time': 2000.0, 'total_elevation_gain': 20.0},
+        {'period': '2024-01', 'count': 1, 'distance': 3000.0,
+            'moving_time': 0.0, 'total_elevation_gain': 0.0}
+    ]
+
+    report = client.get(
+        '/srg/report?srg_athlete_id=123456789&start=2023-11-28&end=2023-12-31&sort=elevation&order=asc&period=week').get_json()
+    assert [a['activityId'] for a in report['activities']] == ['4', '2', '3']
+    assert [t['period'] for t in report['totals']] == [
+        '2023-11-27', '2023-12-04']
+
+    response = client.get(
+        '/srg/report?srg_athlete_id=123456789&sort=bogus')
+    assert response.status_code == 400
+
+
+@mock.patch('requests.Session.get')
+def test_fetch_kudoers_follows_pages(mock_get):
+    class MockResponse:
+        def __init__(self, json_data):
+            self.json_data = json_data
+            self.status_code = 200
+            self.headers = {}
+
+        def json(self):
+            return self.json_data
+    pages = {1: [{'firstname': 'Joe'}] * 200, 2: [{'firstname': 'Gordon'}]}
+    mock_get.side_effect = lambda url, **kwargs: MockResponse(
+        pages[kwargs['params']['page']])
+    kudoers = fetch_entry_kudoers_req('12345', '54321')
+    assert len(kudoers) == 201
+    assert kudoers[-1]['firstname'] == 'Gordon'
+
+    # An error on a later page fails the whole list
+    pages[2] = {'message': 'Authorization Error', 'errors': [
+        {'resource': 'Athlete', 'field': 'access_token', 'code': 'invalid'}]}
+    with pytest.raises(StravaError):
+        fetch_entry_kudoers_req('12345', '54321')
+    assert update_cached_kudos_comments(
+        '19812306', '12345', pages[2], []) == 'dynamo skipped'
+
+
+@mock_dynamodb
+def test_update_cached_kudos_comments_skips_unchanged():
+    table = create_activities_table()
+    table.put_item(Item={'athleteId': '123456789', 'activityId': '987654321',
+                   'kudos_count': 2, 'comment_count': 0})
+    assert update_cached_kudos_comments(
+        '123456789', '987654321', [{}, {}], []) == 'dynamo unchanged'
+    assert update_cached_kudos_comments(
+        '123456789', '987654321', [{}, {}, {}], []) == 'dynamo updated'
+    assert table.scan()['Items'][0]['kudos_count'] == 3
+
+
+def test_write_behind_queue_coalesces_per_key():
+    queue = WriteBehindQueue(workers=1, max_pending=10, enqueue_timeout=0)
+    started = threading.Event()
+    release = threading.Event()
+    writes = []
+
+    def blocking_write(value):
+        started.set()
+        release.wait(5)
+        writes.append(value)
+    queue.enqueue('a', blocking_write, 1)
+    assert started.wait(5)
+    # 'a' is in flight, these three collapse into the last one
+    for value in [2, 3, 4]:
+        queue.enqueue('a', writes.append, value)
+    assert queue.stats()['depth'] == 1
+    release.set()
+    assert queue.shutdown(5)
+    assert writes == [1, 4]
+    stats = queue.stats()
+    assert stats['coalesced'] == 2
+    assert stats['written'] == 2
+
+
+def test_write_behind_queue_backpressure_writes_inline():
+    queue = WriteBehindQueue(workers=1, max_pending=1, enqueue_timeout=0)
+    release = threading.Event()
+    writes = []
+    queue.enqueue('a', lambda: release.wait(5))
+    time.sleep(0.05)
+    queue.enqueue('b', writes.append, 'b')
+    # Queue is full, the caller does the write itself
+    queue.enqueue('c', writes.append, 'c')
+    assert writes == ['c']
+    release.set()
+    assert queue.shutdown(5)
+    assert writes == ['c', 'b']
+    assert queue.stats()['inline'] == 1
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_add_all_activities_endpoint_runs_as_job(mock_get):
+    create_token_table().put_item(Item={
+        'athleteId': '19812306',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    activities_table = create_activities_table()
+    client = app.test_client()
+    response = client.post('/srg/addAllActivities?srg_athlete_id=19812306')
+    assert response.status_code == 202
+    job_id = response.get_json()['jobId']
+
+    for _ in range(100):
+        status = client.get('/srg/syncStatus?srg_athlete_id=19812306').get_json()
+        if status['status'] in ('succeeded', 'failed'):
+            break
+        time.sleep(0.05)
+    assert status['jobId'] == job_id
+    assert status['status'] == 'succeeded'
+    assert status['progress'] == {
+        'pagesFetched': 1, 'activitiesFetched': 1, 'itemsWritten': 1}
+    assert activities_table.scan()['Count'] == 1
+    assert get_sync_checkpoint_req('19812306') is None
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_add_all_activities_resumes_from_checkpoint(mock_get):
+    create_token_table()
+    create_activities_table()
+    save_sync_checkpoint_req(
+        '19812306', {'page': 3, 'after': 1600000000, 'watermark': 1600000001})
+    add_all_activities_req('accessToken', '19812306')
+    params = [call.kwargs['params'] for call in mock_get.call_args_list]
+    assert min(param['page'] for param in params) == 3
+    assert all(param['after'] == 1600000000 for param in params)
+    assert get_sync_checkpoint_req('19812306') is None
+    assert get_sync_watermark_req('19812306') == 1701100001
+
+
+@mock.patch.dict('os.environ', {'strava_webhook_verify_token': 'srg-verify'})
+def test_webhook_subscription_handshake():
+    client = app.test_client()
+    response = client.get(
+        '/srg/webhook?hub.mode=subscribe&hub.verify_token=srg-verify&hub.challenge=15f7d1a91c1f40f8a748fd134752feb3')
+    assert response.get_json() == {
+        'hub.challenge': '15f7d1a91c1f40f8a748fd134752feb3'}
+    response = client.get(
+        '/srg/webhook?hub.mode=subscribe&hub.verify_token=wrong&hub.challenge=abc')
+    assert response.status_code == 403
+
+
+@fresh_strava_client()
+@mock.patch.dict('os.environ', {'strava_webhook_subscription_id': '120475'})
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+@mock_dynamodb
+def test_webhook_events_upsert_and_delete_activity(mock_get):
+    create_token_table().put_item(Item={
+        'athleteId': '19812306',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    activities_table = create_activities_table()
+    create_activity_streams_table()
+    client = app.test_client()
+    event = {'object_type': 'activity', 'object_id': 1624305483, 'aspect_type': 'create',
+             'owner_id': 19812306, 'subscription_id': 120475, 'event_time': 1516126040, 'updates': {}}
+
+    # A burst of events for one activity is fetched once
+    queue = get_webhook_queue()
+    with queue.condition:
+        for aspect_type in ['create', 'update', 'update']:
+            response = client.post(
+                '/srg/webhook', json={**event, 'aspect_type': aspect_type})
+            assert response.status_code == 200
+    assert queue.flush(5)
+    assert get_write_behind_queue().flush(5)
+    assert mock_get.call_count == 1
+    item = activities_table.get_item(
+        Key={'athleteId': '19812306', 'activityId': '1624305483'})['Item']
+    assert item['type'] == 'Run'
+    assert item['individualActivityCached'] is True
+
+    # Nor is a Strava error body, which has no type
+    unauthorized = mock.Mock(status_code=401, headers={})
+    unauthorized.json.return_value = {'message': 'Authorization Error', 'errors': [
+        {'resource': 'Athlete', 'field': 'access_token', 'code': 'invalid'}]}
+    with mock.patch('requests.Session.get', return_value=unauthorized):
+        client.post('/srg/webhook', json={**event, 'aspect_type': 'update'})
+        assert queue.flush(5)
+    assert activities_table.scan()['Count'] == 1
+
+    # A delete Strava doesn't confirm is ignored
+    client.post('/srg/webhook', json={**event, 'aspect_type': 'delete'})
+    assert queue.flush(5)
+    assert activities_table.scan()['Count'] == 1
+
+    mock_get.side_effect = lambda *args, **kwargs: mock.Mock(
+        status_code=404, headers={})
+    client.post('/srg/webhook', json={**event, 'aspect_type': 'delete'})
+    assert queue.flush(5)
+    assert activities_table.scan()['Count'] == 0
+
+
+@mock.patch.dict('os.environ', {'strava_webhook_subscription_id': '120475'})
+def test_webhook_full_queue_refuses_events():
+    queue = WriteBehindQueue(
+        workers=1, max_pending=1, enqueue_timeout=0, overflow_inline=False)
+    release = threading.Event()
+    queue.enqueue('busy', lambda: release.wait(5))
+    time.sleep(0.05)
+    queue.enqueue('waiting', lambda: None)
+    client = app.test_client()
+    event = {'object_type': 'activity', 'object_id': 1, 'aspect_type': 'create',
+             'owner_id': 19812306, 'subscription_id': 120475, 'updates': {}}
+    with mock.patch('webhook_utilities._webhook_queue', queue), mock.patch('webhook_utilities.sync_activity_req') as sync:
+        # Nothing runs on the request thread, Strava redelivers instead
+        assert client.post('/srg/webhook', json=event).status_code == 429
+        assert sync.call_count == 0
+    release.set()
+    assert queue.shutdown(5)
+    assert queue.stats()['rejected'] == 1
+
+
+@fresh_strava_client()
+@mock_dynamodb
+def test_webhook_rejects_forged_events():
+    create_token_table().put_item(Item={
+        'athleteId': '19812306',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    create_activities_table()
+    create_activity_streams_table()
+    client = app.test_client()
+    event = {'object_type': 'athlete', 'object_id': 19812306, 'aspect_type': 'update',
+             'owner_id': 19812306, 'subscription_id': 120475, 'updates': {'authorized': 'false'}}
+    # Without a configured subscription id nothing gets in
+    assert client.post('/srg/webhook', json=event).status_code == 403
+
+    with mock.patch.dict('os.environ', {'strava_webhook_subscription_id': '120475'}):
+        with mock.patch('requests.Session.get', return_value=mock.Mock(status_code=200, headers={})):
+            assert client.post('/srg/webhook', json=event).status_code == 200
+            assert get_webhook_queue().flush(5)
+        assert fetch_tokens('19812306')['accessToken'] == '13579'
+
+        with mock.patch('requests.Session.get', return_value=mock.Mock(status_code=401, headers={})):
+            client.post('/srg/webhook', json=event)
+            assert get_webhook_queue().flush(5)
+        assert 'Item' not in get_table(
+            'srg-token-table').get_item(Key={'athleteId': '19812306'})
+
+
+@mock_dynamodb
+def test_conditional_get_uses_athlete_data_version():
+    create_token_table().put_item(Item={
+        'athleteId': '123456789',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    table = create_activities_table()
+    table.put_item(Item={'athleteId': '123456789',
+                   'activityId': '1', 'name': 'Morning Run'})
+    save_user_settings_req('123456789', 'Run', 'Imperial', 'Week', True)
+    client = app.test_client()
+    urls = ['/srg/allActivities?srg_athlete_id=123456789',
+            '/srg/allActivities?srg_athlete_id=123456789&fields=name',
+            '/srg/generalIndividualEntry/123456789/1',
+            '/srg/getUserSettings?srg_athlete_id=123456789']
+
+    etags = {}
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200
+        etags[url] = response.headers['ETag']
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        assert response.status_code == 304
+        assert response.data == b''
+    assert len(set(etags.values())) == len(urls)
+
+    update_one_activity_req('123456789', '1', 'Evening Run', '')
+    response = client.get(urls[0], headers={'If-None-Match': etags[urls[0]]})
+    assert response.status_code == 200
+    assert response.get_json()[0]['name'] == 'Evening Run'
+    assert response.headers['ETag'] != etags[urls[0]]
+
+
+@mock_dynamodb
+def test_responses_gzip_above_threshold():
+    table = create_activities_table()
+    for activity_id in range(50):
+        table.put_item(Item={'athleteId': '123456789', 'activityId': str(activity_id),
+                       'name': 'Morning Run', 'distance': Decimal('5012.3')})
+    client = app.test_client()
+    url = '/srg/allActivities?srg_athlete_id=123456789'
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.is_streamed
+    assert response.headers['Content-Encoding'] == 'gzip'
+    activities = json.loads(gzip.decompress(response.get_data()))
+    assert len(activities) == 50
+    assert activities[0]['distance'] == '5012.3'
+
+    response = client.get(url + '&limit=40', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.get_data()))) == 40
+
+    # Below the threshold, or when the client can't decode it, send it as is
+    response = client.get(url + '&limit=1', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    response = client.get(url + '&limit=40')
+    assert 'Content-Encoding' not in response.headers
+    assert len(response.get_json()) == 40
+
+    stats = get_response_compressor().stats()['endpoints']['/srg/allActivities']
+    assert stats['compressed'] >= 2
+    assert stats['bytesAfter'] < stats['bytesBefore']
+
+
+@mock_dynamodb
+def test_metrics_endpoint_and_server_timing():
+    create_token_table()
+    save_user_settings_req('123456789', 'Run', 'Imperial', 'Week', True)
+    client = app.test_client()
+
+    response = client.get('/srg/getUserSettings?srg_athlete_id=123456789')
+    assert 'dynamodb;dur=' in response.headers['Server-Timing']
+    assert 'total;dur=' in response.headers['Server-Timing']
+
+    response = client.get('/srg/metrics')
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert 'srg_request_duration_seconds_count{method="GET",route="/srg/getUserSettings",status="200"}' in body
+    assert 'srg_dependency_duration_seconds_bucket{dependency="dynamodb",operation="GetItem",le="+Inf"}' in body
+    assert 'srg_executor_threads{pool="strava",state="maxWorkers"} 8' in body
+    assert '# TYPE srg_rate_limit_errors_total counter' in body
+
+
+@mock.patch('requests.Session.get', side_effect=mocked_requests_get)
+def test_strava_calls_are_timed_per_operation(mock_get):
+    metrics = get_metrics()
+    before = metrics.dependency_duration.count(
+        'strava', 'GET /activities/:id/kudos')
+    fetch_entry_kudoers_req('12345', '24680')
+    assert metrics.dependency_duration.count(
+        'strava', 'GET /activities/:id/kudos') > before
+
+
+@mock_dynamodb
+def test_profiling_is_token_protected_and_rate_limited():
+    create_token_table()
+    save_user_settings_req('123456789', 'Run', 'Imperial', 'Week', True)
+    profiler = get_request_profiler()
+    client = app.test_client()
+    url = '/srg/getUserSettings?srg_athlete_id=123456789'
+    with mock.patch.multiple(profiler, token='secret', min_interval=60, last_started=0.0):
+        response = client.get(url, headers={'X-SRG-Profile': 'wrong'})
+        assert 'X-SRG-Profile' not in response.headers
+
+        response = client.get(url, headers={'X-SRG-Profile': 'secret'})
+        profile_id = response.headers['X-SRG-Profile']
+        assert response.get_json()['defaultSport'] == 'Run'
+        response = client.get(url + '&srg_profile=secret')
+        assert response.headers['X-SRG-Profile'] == 'skipped'
+
+        assert client.get(f"/srg/profiles/{profile_id}").status_code == 403
+        profile = client.get(f"/srg/profiles/{profile_id}",
+                             headers={'X-SRG-Profile': 'secret'}).get_json()
+        assert profile['path'] == url
+        assert any('get_user_settings_req' in row['function']
+                   for row in profile['top'])
+        response = client.get(f"/srg/profiles/{profile_id}?format=collapsed",
+                              headers={'X-SRG-Profile': 'secret'})
+        assert response.mimetype == 'text/plain'
+
+
+def test_strava_client_retries_gets_and_opens_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    client = StravaClient(pool_size=4, connect_timeout=1,
+                          read_timeout=2, breaker=breaker, max_retries=2)
+    responses = [requests.ConnectionError(), mock.Mock(
+        status_code=503, headers={}), mock.Mock(status_code=200, headers={})]
+    with mock.patch('requests.Session.get', side_effect=responses) as mock_get, mock.patch('time.sleep'):
+        assert client.get(
+            'https://www.strava.com/api/v3/athlete').status_code == 200
+    assert mock_get.call_count == 3
+    assert breaker.stats()['state'] == 'closed'
+
+    # Writes aren't retried, and once open the breaker fails fast
+    with mock.patch('requests.Session.put', side_effect=requests.Timeout()) as mock_put:
+        for _ in range(3):
+            with pytest.raises(StravaUnavailableError):
+                client.put('https://www.strava.com/api/v3/activities/1')
+        assert mock_put.call_count == 3
+        with pytest.raises(StravaUnavailableError) as error:
+            client.put('https://www.strava.com/api/v3/activities/1')
+        assert mock_put.call_count == 3
+    assert error.value.retry_after > 0
+    assert breaker.stats()['state'] == 'open'
+
+
+def test_strava_client_keeps_no_cookies():
+    client = StravaClient(pool_size=4, connect_timeout=1, read_timeout=2)
+    with responses.RequestsMock() as strava:
+        strava.add(responses.GET, 'https://www.strava.com/api/v3/athlete',
+                   json={'id': 1}, headers={'Set-Cookie': '_strava4_session=athlete-1; Path=/'})
+        assert client.get('https://www.strava.com/api/v3/athlete',
+                          access_token='athlete-1').cookies['_strava4_session'] == 'athlete-1'
+    assert len(client.session.cookies) == 0
+
+
+def test_oauth_calls_bypass_the_rate_limiter():
+    rate_limiter = StravaRateLimiter(
+        short_limit=1, daily_limit=1, interactive_reserve=0, max_bulk_wait=0)
+    rate_limiter.acquire(INTERACTIVE)
+    client = StravaClient(pool_size=4, connect_timeout=1,
+                          read_timeout=2, rate_limiter=rate_limiter)
+    with mock.patch('requests.Session.post', return_value=mock.Mock(status_code=200, headers={})):
+        assert client.post('https://www.strava.com/api/v3/oauth/token',
+                           rate_limited=False).status_code == 200
+        with pytest.raises(RateLimitError):
+            client.post('https://www.strava.com/api/v3/activities')
+    assert rate_limiter.stats()['shortWindow']['usage'] == 1
+
+
+def test_strava_breaker_probe_settles_on_any_error():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    client = StravaClient(pool_size=4, connect_timeout=1,
+                          read_timeout=2, breaker=breaker, max_retries=0)
+    url = 'https://www.strava.com/api/v3/athlete'
+    for error in [requests.ConnectionError(), requests.exceptions.ChunkedEncodingError(), ValueError()]:
+        with mock.patch('requests.Session.get', side_effect=error):
+            with pytest.raises((StravaUnavailableError, ValueError)):
+                client.get(url)
+    # Each failed probe left the circuit able to probe again
+    with mock.patch('requests.Session.get', return_value=mock.Mock(status_code=200, headers={})):
+        assert client.get(url).status_code == 200
+    assert breaker.stats()['state'] == 'closed'
+
+
+def test_strava_client_deadline_starts_after_budget_wait():
+    # A bulk call paced past its deadline by our own budget still gets the
+    # full timeout, and nothing it does counts against Strava
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    rate_limiter = mock.Mock(acquire=lambda priority: time.sleep(0.2))
+    client = StravaClient(pool_size=4, connect_timeout=1, read_timeout=2, rate_limiter=rate_limiter,
+                          breaker=breaker, deadlines={INTERACTIVE: 0.1, BULK: 0.1})
+    with mock.patch('requests.Session.get', return_value=mock.Mock(status_code=200, headers={})) as mock_get:
+        assert client.get('https://www.strava.com/api/v3/activities/1',
+                          priority=BULK).status_code == 200
+    assert mock_get.call_args.kwargs['timeout'][0] > 0.05
+
+    with mock.patch('requests.Session.get', side_effect=requests.ReadTimeout()), mock.patch('time.sleep'):
+        with pytest.raises(StravaUnavailableError):
+            client.get('https://www.strava.com/api/v3/activities/1',
+                       priority=BULK)
+    assert breaker.stats()['state'] == 'closed'
+
+
+@fresh_strava_client()
+@mock_dynamodb
+def test_individual_entry_served_stale_while_strava_unavailable():
+    create_token_table().put_item(Item={
+        'athleteId': '24680',
+        'accessToken': '13579',
+        'refreshToken': '24680',
+        'expiresAt': 4102444800
+    })
+    table = create_activities_table()
+    table.put_item(Item={'athleteId': '24680', 'activityId': '1624305483',
+                   'individualActivityCached': True, 'individualActivityCachedAt': 1})
+    client = app.test_client()
+    url = '/srg/individualEntry/1624305483?srg_athlete_id=24680'
+    bad_gateway = mock.Mock(status_code=502, headers={})
+    bad_gateway.json.side_effect = ValueError('not JSON')
+    with mock.patch('requests.Session.get', return_value=bad_gateway), mock.patch('time.sleep'):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.get_json()['activityId'] == '1624305483'
+
+    with mock.patch('requests.Session.get', side_effect=requests.ConnectionError()), mock.patch('time.sleep'):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.get_json()['activityId'] == '1624305483'
+
+        response = client.get('/srg/entryKudos/1624305483?srg_athlete_id=24680')
+        assert response.status_code == 503
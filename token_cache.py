@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenCache:
+    def __init__(self, max_size, ttl, safety_margin, refresh_ahead):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Tokens this close to expiresAt are treated as already expired
+        self.safety_margin = safety_margin
+        # and this close are refreshed in the background
+        self.refresh_ahead = refresh_ahead
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 1024)),
+            ttl=float(os.environ.get('TOKEN_CACHE_TTL', 3600)),
+            safety_margin=float(os.environ.get(
+                'TOKEN_CACHE_SAFETY_MARGIN', 120)),
+            refresh_ahead=float(os.environ.get(
+                'TOKEN_CACHE_REFRESH_AHEAD', 600))
+        )
+
+    def is_fresh(self, tokens, now=None):
+        now = time.time() if now is None else now
+        return now < float(tokens['expiresAt']) - self.safety_margin
+
+    def needs_refresh(self, tokens, now=None):
+        now = time.time() if now is None else now
+        return now >= float(tokens['expiresAt']) - self.refresh_ahead
+
+    def get(self, athlete_id):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(athlete_id)
+            if entry is not None:
+                tokens, cached_at = entry
+                if now - cached_at < self.ttl and self.is_fresh(tokens, now):
+                    self.entries.move_to_end(athlete_id)
+                    self.hits += 1
+                    return tokens
+                del self.entries[athlete_id]
+            self.misses += 1
+            return None
+
+    def put(self, athlete_id, tokens):
+        with self.lock:
+            self.entries[athlete_id] = (tokens, time.time())
+            self.entries.move_to_end(athlete_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, athlete_id):
+        with self.lock:
+            self.entries.pop(athlete_id, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxSize': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class SingleFlight:
+    # Concurrent callers for the same key share one execution of fn
+    class Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight.Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = TokenCache.from_env()
+    return _token_cache
@@ -0,0 +1,176 @@
+import atexit
+import os
+import threading
+from flask import Blueprint, make_response, request, jsonify
+from auth_utilities import get_access_token_from_athlete_id, fetch_tokens, upsert_tokens
+from token_cache import get_token_cache
+from strava_client import get_strava_client, STRAVA_API_URL
+from dynamo_utilities import get_table
+from data_version import bump_data_version
+from rate_limiter import BULK, RateLimitError
+from write_behind import WriteBehindQueue
+from data_utilities import ingest_activities, upload_individual_entry_data_to_db, destroy_user_req, destroy_user_tokens_req
+
+webhook_controller_bp = Blueprint('webhook_controller', __name__)
+
+SYNCED_TYPES = ["Walk", "Swim", "Run", "Ride"]
+
+
+@webhook_controller_bp.route('/srg/webhook', methods=['GET'])
+def route_validate_webhook():
+    return validate_webhook()
+
+
+def validate_webhook():
+    # Strava's subscription handshake, echo the challenge back if the
+    # verify token is the one we registered with
+    verify_token = os.environ.get('strava_webhook_verify_token')
+    if request.args.get('hub.mode') != 'subscribe' or not verify_token or request.args.get('hub.verify_token') != verify_token:
+        return make_response(jsonify({'error': 'Invalid Verify Token'}), 403)
+    return jsonify({'hub.challenge': request.args.get('hub.challenge')})
+
+
+@webhook_controller_bp.route('/srg/webhook', methods=['POST'])
+def route_receive_webhook_event():
+    return receive_webhook_event()
+
+
+def receive_webhook_event():
+    event = request.get_json(silent=True) or {}
+    # Events are unauthenticated, without a subscription id to match nothing
+    # is accepted
+    subscription_id = os.environ.get('strava_webhook_subscription_id')
+    if not subscription_id or str(event.get('subscription_id')) != subscription_id:
+        return make_response(jsonify({'error': 'Unknown Subscription'}), 403)
+    # Strava wants an answer within two seconds, the work happens on the queue
+    if not enqueue_webhook_event(event):
+        # Strava redelivers events it didn't get a 200 for
+        return make_response(jsonify({'error': 'Webhook Queue Full'}), 429)
+    return jsonify({'status': 'success', 'message': 'Event Received'})
+
+
+def enqueue_webhook_event(event):
+    owner_id = str(event.get('owner_id'))
+    object_id = str(event.get('object_id'))
+    object_type = event.get('object_type')
+    aspect_type = event.get('aspect_type')
+    queue = get_webhook_queue()
+    # Events for the same object are deduplicated while they wait, the
+    # newest one wins (an update then a delete only deletes)
+    if object_type == 'activity':
+        if aspect_type == 'delete':
+            return queue.enqueue(('activity', owner_id, object_id),
+                                 confirm_delete_activity_req, owner_id, object_id)
+        return queue.enqueue(('activity', owner_id, object_id),
+                             sync_activity_req, owner_id, object_id)
+    if object_type == 'athlete' and str(event.get('updates', {}).get('authorized')).lower() == 'false':
+        return queue.enqueue(('athlete', owner_id),
+                             confirm_deauthorize_athlete_req, owner_id)
+    return True
+
+
+def fetch_activity_req(srg_athlete_id, activity_id):
+    access_token = get_access_token_from_athlete_id(srg_athlete_id)
+    return get_strava_client().get(
+        f"{STRAVA_API_URL}/activities/{activity_id}?include_all_efforts=true", access_token=access_token, priority=BULK)
+
+
+def sync_activity_req(srg_athlete_id, activity_id):
+    response = fetch_activity_req(srg_athlete_id, activity_id)
+    if response.status_code == 429:
+        raise RateLimitError('Rate Limit Exceeded')
+    data = response.json() if response.status_code == 200 else None
+    # An error body has no type either, it must never read as a deletion
+    if not isinstance(data, dict) or 'errors' in data or 'id' not in data:
+        raise ValueError(
+            f"Strava answered {response.status_code} for activity {activity_id}")
+    if data.get('type') and data['type'] not in SYNCED_TYPES:
+        # Covers an activity edited into a sport we don't keep
+        return delete_activity_req(srg_athlete_id, activity_id)
+    ingest_activities([data])
+    upload_individual_entry_data_to_db(data, srg_athlete_id, activity_id)
+    return 'synced'
+
+
+def delete_activity_req(srg_athlete_id, activity_id):
+    key = {'athleteId': srg_athlete_id, 'activityId': activity_id}
+    get_table('srg-activities-table').delete_item(Key=key)
+    get_table('srg-activity-streams-table').delete_item(Key=key)
+    bump_data_version(srg_athlete_id)
+    return 'deleted'
+
+
+def confirm_delete_activity_req(srg_athlete_id, activity_id):
+    # Anyone can post an event, only Strava saying it's gone deletes it
+    response = fetch_activity_req(srg_athlete_id, activity_id)
+    if response.status_code != 404:
+        return 'kept'
+    return delete_activity_req(srg_athlete_id, activity_id)
+
+
+def athlete_revoked_access(srg_athlete_id):
+    try:
+        tokens = fetch_tokens(srg_athlete_id)
+    except KeyError:
+        return False
+    strava_client = get_strava_client()
+    if get_token_cache().is_fresh(tokens):
+        response = strava_client.get(
+            f"{STRAVA_API_URL}/athlete", access_token=tokens['accessToken'], priority=BULK)
+        return response.status_code == 401
+    response = strava_client.post(f"{STRAVA_API_URL}/oauth/token", data={
+        'client_id': os.environ.get('strava_client_id'),
+        'client_secret': os.environ.get('strava_client_secret'),
+        'grant_type': 'refresh_token',
+        'refresh_token': tokens['refreshToken']
+    }, priority=BULK, rate_limited=False)
+    if response.status_code == 200:
+        # Still authorized, keep what the refresh handed out
+        strava_tokens = response.json()
+        upsert_tokens({
+            'athlete_id': srg_athlete_id,
+            'access_token': strava_tokens['access_token'],
+            'refresh_token': strava_tokens['refresh_token'],
+            'expires_at': strava_tokens['expires_at']
+        })
+        return False
+    # Strava answers a revoked refresh token with a 400 or a 401
+    return response.status_code in (400, 401)
+
+
+def confirm_deauthorize_athlete_req(srg_athlete_id):
+    if not athlete_revoked_access(srg_athlete_id):
+        return 'kept'
+    return deauthorize_athlete_req(srg_athlete_id)
+
+
+def deauthorize_athlete_req(srg_athlete_id):
+    # Strava requires an athlete's data to go when they revoke access
+    destroy_user_req(srg_athlete_id)
+    destroy_user_req(srg_athlete_id, table_name='srg-activity-streams-table')
+    destroy_user_tokens_req(srg_athlete_id)
+    return 'deauthorized'
+
+
+_webhook_queue = None
+_webhook_queue_lock = threading.Lock()
+
+
+def get_webhook_queue():
+    global _webhook_queue
+    if _webhook_queue is None:
+        with _webhook_queue_lock:
+            if _webhook_queue is None:
+                _webhook_queue = WriteBehindQueue(
+                    workers=int(os.environ.get('WEBHOOK_WORKERS', 2)),
+                    max_pending=int(os.environ.get(
+                        'WEBHOOK_MAX_PENDING', 1000)),
+                    enqueue_timeout=float(os.environ.get(
+                        'WEBHOOK_ENQUEUE_TIMEOUT', 1)),
+                    # Processing an event can wait minutes on the bulk
+                    # budget, never on a request thread
+                    overflow_inline=False
+                )
+                atexit.register(_webhook_queue.shutdown, float(
+                    os.environ.get('WRITE_BEHIND_SHUTDOWN_TIMEOUT', 20)))
+    return _webhook_queue
@@ -0,0 +1,158 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from pprint import pprint
+
+
+class WriteBehindQueue:
+    def __init__(self, workers, max_pending, enqueue_timeout, overflow_inline=True):
+        # Pending writes keyed so a newer write for the same item replaces
+        # the older one still waiting, last write wins. When full the caller
+        # does the write itself, or with overflow_inline off it's refused
+        self.pending = OrderedDict()
+        self.overflow_inline = overflow_inline
+        self.in_flight = set()
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.inline = 0
+        self.rejected = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+        self.workers = [threading.Thread(target=self._work, name=f"srg-write-behind-{i}", daemon=True)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.environ.get('WRITE_BEHIND_WORKERS', 2)),
+            max_pending=int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000)),
+            enqueue_timeout=float(os.environ.get(
+                'WRITE_BEHIND_ENQUEUE_TIMEOUT', 1))
+        )
+
+    def enqueue(self, key, fn, *args):
+        # False when the queue was full and refused the task
+        with self.condition:
+            if key in self.pending:
+                self.pending[key] = (fn, args)
+                self.coalesced += 1
+                return True
+            # Backpressure: wait for room, and if the workers can't keep up
+            # make the caller do the write itself rather than grow the queue
+            deadline = time.time() + self.enqueue_timeout
+            while len(self.pending) >= self.max_pending and not self.stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if len(self.pending) < self.max_pending and not self.stopping:
+                self.pending[key] = (fn, args)
+                self.enqueued += 1
+                self.condition.notify_all()
+                return True
+            if not self.overflow_inline:
+                self.rejected += 1
+                return False
+            self.inline += 1
+        self._write(fn, args)
+        return True
+
+    def _next(self):
+        # Skip keys already being written so writes to one item stay in order
+        for key in self.pending:
+            if key not in self.in_flight:
+                fn, args = self.pending.pop(key)
+                self.in_flight.add(key)
+                return key, fn, args
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                task = self._next()
+                while task is None:
+                    if self.stopping and not self.pending:
+                        return
+                    self.condition.wait()
+                    task = self._next()
+            key, fn, args = task
+            self._write(fn, args)
+            with self.condition:
+                self.in_flight.discard(key)
+                self.condition.notify_all()
+
+    def _write(self, fn, args):
+        started = time.time()
+        try:
+            fn(*args)
+            succeeded = True
+        except Exception as e:
+            pprint(e)
+            succeeded = False
+        elapsed = time.time() - started
+        with self.condition:
+            if succeeded:
+                self.written += 1
+            else:
+                self.failed += 1
+            self.write_seconds += elapsed
+            self.max_write_seconds = max(self.max_write_seconds, elapsed)
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=None):
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        return flushed
+
+    def stats(self):
+        with self.condition:
+            completed = self.written + self.failed
+            return {
+                'depth': len(self.pending),
+                'inFlight': len(self.in_flight),
+                'maxPending': self.max_pending,
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'inline': self.inline,
+                'rejected': self.rejected,
+                'written': self.written,
+                'failed': self.failed,
+                'averageWriteSeconds': self.write_seconds / completed if completed else 0.0,
+                'maxWriteSeconds': self.max_write_seconds
+            }
+
+
+_write_behind_queue = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def get_write_behind_queue():
+    global _write_behind_queue
+    if _write_behind_queue is None:
+        with _write_behind_queue_lock:
+            if _write_behind_queue is None:
+                _write_behind_queue = WriteBehindQueue.from_env()
+                atexit.register(_write_behind_queue.shutdown, float(
+                    os.environ.get('WRITE_BEHIND_SHUTDOWN_TIMEOUT', 20)))
+    return _write_behind_queue